@@ -0,0 +1,150 @@
+# Copyright (C) 2021 Ikomia SAS
+# Contact: https://www.ikomia.com
+#
+# This file is part of the IkomiaStudio software.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import asyncio
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class _Request:
+    __slots__ = ("image", "options", "future")
+
+    def __init__(self, image, options, future):
+        self.image = image
+        self.options = options
+        self.future = future
+
+
+class AsyncSegmenter:
+    # asyncio front end of a segmentation task: mask = await segmenter.infer(image).
+    # Requests awaited concurrently are grouped into batches of up to max_batch images
+    # (default: batch_size parameter of the task), waiting at most max_wait_ms for a batch
+    # to fill, and run by task.infer_batch() on a dedicated executor. A request cancelled
+    # or timed out before its batch starts is dropped from the batch.
+    # Bound to the event loop of its first call.
+
+    def __init__(self, task, max_batch=0, max_wait_ms=5.0, executor=None):
+        self.task = task
+        self.max_batch = max_batch
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        # One thread by default: calls to the task are not run concurrently
+        self.executor = executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix="mmseg_async")
+        self._own_executor = executor is None
+        self._pending = deque()
+        self._wakeup = None
+        self._batcher = None
+        self._closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def infer(self, image, scale=1.0, roi=None, timeout=None):
+        # uint8 mask of image, same arguments as task.infer_batch(). timeout in seconds,
+        # asyncio.TimeoutError when exceeded.
+        if self._closed:
+            raise Exception("AsyncSegmenter is closed")
+
+        loop = asyncio.get_running_loop()
+        if self._batcher is None:
+            self._wakeup = asyncio.Event()
+            self._batcher = loop.create_task(self._batch_loop())
+
+        future = loop.create_future()
+        self._pending.append(_Request(image, (scale, tuple(roi) if roi is not None else None), future))
+        self._wakeup.set()
+        # Cancelling the caller or reaching the timeout cancels the future
+        return await asyncio.wait_for(future, timeout)
+
+    def _max_batch(self):
+        return max(1, self.max_batch or self.task.get_param_object().batch_size)
+
+    def _take(self, max_batch):
+        # Leading requests with the same options, in arrival order, skipping cancelled ones
+        batch = []
+        while self._pending and len(batch) < max_batch:
+            request = self._pending[0]
+            if request.future.done():
+                self._pending.popleft()
+                continue
+            if batch and request.options != batch[0].options:
+                break
+            batch.append(self._pending.popleft())
+
+        return batch
+
+    async def _fill(self, loop, max_batch):
+        # Until max_batch requests are waiting or the oldest one waited max_wait
+        deadline = loop.time() + self.max_wait
+        while len(self._pending) < max_batch and not self._closed:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), remaining)
+            except asyncio.TimeoutError:
+                return
+
+    async def _run(self, loop, batch):
+        scale, roi = batch[0].options
+        images = [request.image for request in batch]
+        try:
+            masks = await loop.run_in_executor(self.executor,
+                                               functools.partial(self.task.infer_batch, images, scale, roi))
+        except Exception as e:
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+            return
+
+        for request, mask in zip(batch, masks):
+            if not request.future.done():
+                request.future.set_result(mask)
+
+    async def _batch_loop(self):
+        # New requests keep queuing while a batch runs: they form the next one
+        loop = asyncio.get_running_loop()
+        while True:
+            while not self._pending:
+                if self._closed:
+                    return
+                self._wakeup.clear()
+                await self._wakeup.wait()
+
+            max_batch = self._max_batch()
+            await self._fill(loop, max_batch)
+            batch = self._take(max_batch)
+            if batch:
+                await self._run(loop, batch)
+
+    async def close(self):
+        # Requests not started yet are cancelled, the running batch completes
+        self._closed = True
+        while self._pending:
+            self._pending.popleft().future.cancel()
+
+        if self._batcher is not None:
+            self._wakeup.set()
+            await self._batcher
+            self._batcher = None
+
+        if self._own_executor:
+            self.executor.shutdown(wait=False)
@@ -0,0 +1,325 @@
+# Copyright (C) 2021 Ikomia SAS
+# Contact: https://www.ikomia.com
+#
+# This file is part of the IkomiaStudio software.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import hashlib
+import os
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+import cv2
+import numpy as np
+import torch
+
+from infer_mmlab_segmentation import checkpoint_store, postprocess, profiling, zoo_index
+from infer_mmlab_segmentation.export import Exporter
+
+BACKENDS = ["pytorch", "onnxruntime", "openvino"]
+
+# Bump when exported graphs or their meta data change
+EXPORT_VERSION = 1
+
+_plugin_folder = os.path.dirname(os.path.abspath(__file__))
+EXPORT_FOLDER = os.environ.get("IKOMIA_MMSEG_EXPORT_FOLDER", os.path.join(_plugin_folder, "models", "export"))
+
+
+def export_key(cfg_file, ckpt_file):
+    # Content of the config and of its _base_ chain + checkpoint identity: edited configs
+    # (parents included) or new weights give a new export
+    h = hashlib.sha1(str(EXPORT_VERSION).encode())
+    for f in zoo_index.config_chain(cfg_file):
+        if os.path.isfile(f):
+            with open(f, "rb") as fp:
+                h.update(fp.read())
+
+    st = os.stat(ckpt_file)
+    h.update(f"{os.path.basename(ckpt_file)}:{st.st_size}:{st.st_mtime_ns}".encode())
+    return h.hexdigest()[:16]
+
+
+class ExportedSegmentor:
+    # Inference of an exported graph without mmseg: numpy equivalent of the test pipeline and
+    # SegDataPreProcessor, backend specific forward pass, masks from postprocess.mask_from_logits.
+    # Subclasses implement _load(onnx_file) and _run(graph, batch).
+
+    def __init__(self, exporter):
+        self.exporter = exporter
+        self.meta = exporter.meta()
+        self.classes = self.meta["classes"]
+        self.nbytes = 0
+        self._update_nbytes()
+        self._graphs = {}
+        self._lock = threading.Lock()
+        self._order = [2, 1, 0] if self.meta["channel_conversion"] else [0, 1, 2]
+        if self.meta["mean"] is not None:
+            self._mean = np.array(self.meta["mean"], dtype=np.float32)
+            self._std = np.array(self.meta["std"], dtype=np.float32)
+
+    def _update_nbytes(self):
+        # Approximate memory footprint for the model cache: size of the graphs exported so far
+        folder = self.exporter.folder
+        self.nbytes = sum(os.path.getsize(os.path.join(folder, f)) for f in os.listdir(folder)
+                          if f.startswith("model") and f.endswith(".onnx"))
+
+    def _resized_shape(self, h, w, resolution=1.0):
+        # mmcv Resize: fixed scale or scale factor, then rescale_size() if keep_ratio.
+        # resolution scales the config Resize like dynamic_resolution.scale_pipeline_cfg()
+        resize = self.meta["resize"]
+        if resize is None:
+            if resolution == 1.0:
+                return h, w
+            resize = {"scale": None, "scale_factor": 1.0, "keep_ratio": True}
+
+        if resize["scale"] is not None:
+            scale_w, scale_h = (max(1, int(s * resolution + 0.5)) for s in resize["scale"])
+        else:
+            factor = resize["scale_factor"]
+            factor_w, factor_h = factor if isinstance(factor, list) else (factor, factor)
+            scale_w, scale_h = int(w * factor_w * resolution + 0.5), int(h * factor_h * resolution + 0.5)
+
+        if not resize["keep_ratio"]:
+            return scale_h, scale_w
+
+        ratio = min(max(scale_w, scale_h) / max(h, w), min(scale_w, scale_h) / min(h, w))
+        return int(h * ratio + 0.5), int(w * ratio + 0.5)
+
+    def _padding(self, h, w):
+        if self.meta["pad_size"] is not None:
+            pad_h, pad_w = self.meta["pad_size"]
+            return max(pad_h - h, 0), max(pad_w - w, 0)
+
+        divisor = self.meta["pad_size_divisor"]
+        if divisor:
+            return -h % divisor, -w % divisor
+
+        return 0, 0
+
+    def preprocess(self, image, resolution=1.0):
+        # uint8 HWC image -> normalized, padded CHW float32 array and mask meta data
+        ori_shape = image.shape[:2]
+        h, w = self._resized_shape(*ori_shape, resolution)
+        if (h, w) != image.shape[:2]:
+            image = cv2.resize(image, (w, h), interpolation=cv2.INTER_LINEAR)
+
+        inputs = image[..., self._order].astype(np.float32)
+        if self.meta["mean"] is not None:
+            inputs -= self._mean
+            inputs /= self._std
+
+        bottom, right = self._padding(h, w)
+        inputs = np.pad(inputs, ((0, bottom), (0, right), (0, 0)), constant_values=self.meta["pad_val"])
+        meta = {"ori_shape": ori_shape, "padding_size": [0, right, 0, bottom]}
+        return np.ascontiguousarray(inputs.transpose(2, 0, 1)), meta
+
+    def prepare(self, images, resolution=1.0):
+        # Images giving the same preprocessed shape -> (N, C, H, W) batch and meta data
+        prepared = [self.preprocess(img, resolution) for img in images]
+        return np.stack([p[0] for p in prepared]), [p[1] for p in prepared]
+
+    def _graph(self, shape):
+        key = None if self.meta["dynamic"] else shape
+        with self._lock:
+            graph = self._graphs.get(key)
+            if graph is None:
+                onnx_file = self.exporter.graph_file(shape)
+                self.meta["dynamic"] = self.exporter.meta()["dynamic"]
+                graph = self._load(onnx_file)
+                self._graphs[None if self.meta["dynamic"] else shape] = graph
+                self._update_nbytes()
+                if self.meta["dynamic"]:
+                    # No further export needed
+                    self.exporter.release()
+
+            return graph
+
+    def forward(self, batch):
+        return self._run(self._graph(batch.shape[2:]), batch)
+
+    def masks(self, logits, metas, scale=1.0, roi=None):
+        logits = torch.from_numpy(logits)
+        return [postprocess.mask_from_logits(logits[i:i + 1], meta, self.meta["align_corners"],
+                                             self.meta["threshold"], scale, roi)
+                for i, meta in enumerate(metas)]
+
+    def infer_batch(self, images, batch_size=1, scale=1.0, roi=None, timer=None, resolution=1.0):
+        # Same contract as inference.infer_batch(): list of images -> list of uint8 masks
+        with profiling.stage(timer, "pipeline"):
+            prepared = [self.preprocess(img, resolution) for img in images]
+
+        groups = OrderedDict()
+        for i, (inputs, _) in enumerate(prepared):
+            groups.setdefault(inputs.shape, []).append(i)
+
+        masks = [None] * len(images)
+        batch_size = max(1, batch_size)
+        for indices in groups.values():
+            for start in range(0, len(indices), batch_size):
+                chunk = indices[start:start + batch_size]
+                metas = [prepared[i][1] for i in chunk]
+                with profiling.stage(timer, "forward"):
+                    logits = self.forward(np.stack([prepared[i][0] for i in chunk]))
+                with profiling.stage(timer, "postprocess"):
+                    for i, mask in zip(chunk, self.masks(logits, metas, scale, roi)):
+                        masks[i] = mask
+
+        return masks
+
+
+class OnnxRuntimeSegmentor(ExportedSegmentor):
+
+    def __init__(self, exporter, intra_op_threads=0, inter_op_threads=0):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise Exception("The onnxruntime backend requires the onnxruntime package: pip install onnxruntime")
+
+        self.ort = onnxruntime
+        self.options = onnxruntime.SessionOptions()
+        self.options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # 0 lets ONNX Runtime choose (one thread per physical core for intra-op)
+        self.options.intra_op_num_threads = intra_op_threads
+        self.options.inter_op_num_threads = inter_op_threads
+        if inter_op_threads > 1:
+            self.options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+        super().__init__(exporter)
+
+    def _load(self, onnx_file):
+        return self.ort.InferenceSession(onnx_file, self.options, providers=["CPUExecutionProvider"])
+
+    def _run(self, session, batch):
+        # Graphs from the dynamo exporter of torch < 2.5 do not name their input "inputs"
+        return session.run(None, {session.get_inputs()[0].name: batch})[0]
+
+
+class OpenVinoSegmentor(ExportedSegmentor):
+    # ONNX graph converted once to OpenVINO IR (.xml/.bin next to it). Compiled models are
+    # cached by OpenVINO in the export folder, so that later loads skip compilation.
+    # Throughput mode: the CPU is split into streams fed by an asynchronous infer queue. Images of
+    # a batch, frames of a stream and concurrent calls (tasks sharing the model) run on different
+    # streams at the same time.
+
+    def __init__(self, exporter, intra_op_threads=0, num_streams=0):
+        try:
+            import openvino
+        except ImportError:
+            raise Exception("The openvino backend requires the openvino package: pip install openvino")
+
+        self.ov = openvino
+        self.core = openvino.Core()
+        self.core.set_property({"CACHE_DIR": os.path.join(exporter.folder, "openvino_cache")})
+        # f32: the CPU plugin would otherwise default to bf16 on recent Xeons and change masks
+        self.config = {"PERFORMANCE_HINT": "THROUGHPUT", "INFERENCE_PRECISION_HINT": "f32"}
+        if num_streams > 0:
+            self.config["NUM_STREAMS"] = str(num_streams)
+        if intra_op_threads > 0:
+            self.config["INFERENCE_NUM_THREADS"] = str(intra_op_threads)
+
+        # Compiled model id -> AsyncInferQueue with the optimal number of infer requests
+        self._queues = {}
+        self._queues_lock = threading.Lock()
+        self._submit_lock = threading.Lock()
+        super().__init__(exporter)
+
+    def _load(self, onnx_file):
+        ir_file = os.path.splitext(onnx_file)[0] + ".xml"
+        if not os.path.isfile(ir_file):
+            # Keep FP32 weights: same masks as the other backends
+            ir_model = self.core.read_model(onnx_file)
+            tmp_file = f"{os.path.splitext(onnx_file)[0]}.{os.getpid()}.tmp.xml"
+            self.ov.save_model(ir_model, tmp_file, compress_to_fp16=False)
+            os.replace(os.path.splitext(tmp_file)[0] + ".bin", os.path.splitext(ir_file)[0] + ".bin")
+            os.replace(tmp_file, ir_file)
+
+        return self.core.compile_model(ir_file, "CPU", self.config)
+
+    @staticmethod
+    def _done(request, future):
+        try:
+            future.set_result(request.get_output_tensor(0).data.copy())
+        except Exception as e:
+            future.set_exception(e)
+
+    def _queue(self, compiled_model):
+        with self._queues_lock:
+            queue = self._queues.get(id(compiled_model))
+            if queue is None:
+                queue = self._queues[id(compiled_model)] = self.ov.AsyncInferQueue(compiled_model)
+                queue.set_callback(self._done)
+
+            return queue
+
+    def submit(self, batch):
+        # Future of the logits of a preprocessed batch, run on the first idle infer request.
+        # Blocks while every infer request is busy.
+        queue = self._queue(self._graph(batch.shape[2:]))
+        future = Future()
+        with self._submit_lock:
+            queue.start_async({0: batch}, future)
+
+        return future
+
+    def _run(self, compiled_model, batch):
+        return self.submit(batch).result()
+
+    def infer_batch(self, images, batch_size=1, scale=1.0, roi=None, timer=None, resolution=1.0):
+        # One job per image, run on parallel streams: batch_size is not used
+        with profiling.stage(timer, "pipeline"):
+            prepared = [self.preprocess(img, resolution) for img in images]
+
+        with profiling.stage(timer, "forward"):
+            futures = [self.submit(inputs[None]) for inputs, _ in prepared]
+
+        masks = []
+        for future, (_, meta) in zip(futures, prepared):
+            with profiling.stage(timer, "forward"):
+                logits = future.result()
+            with profiling.stage(timer, "postprocess"):
+                masks.append(self.masks(logits, [meta], scale, roi)[0])
+
+        return masks
+
+    def map(self, frames, max_in_flight=None):
+        # Generator over an iterable of frames, masks yielded in order. Frames are preprocessed
+        # and their masks extracted while the next ones run, at most max_in_flight frames
+        # submitted ahead (default: 2 per infer request)
+        pending = deque()
+        for frame in frames:
+            inputs, meta = self.preprocess(frame)
+            future = self.submit(inputs[None])
+            pending.append((future, meta))
+            limit = max_in_flight or 2 * len(self._queue(self._graph(inputs.shape[1:])))
+            while len(pending) >= limit or (pending and pending[0][0].done()):
+                future, meta = pending.popleft()
+                yield self.masks(future.result(), [meta])[0]
+
+        while pending:
+            future, meta = pending.popleft()
+            yield self.masks(future.result(), [meta])[0]
+
+
+def load(backend, cfg_file, ckpt_file, **options):
+    # Exported runtime of a (config, checkpoint) couple. Graphs are exported on first use
+    # and cached in EXPORT_FOLDER, later loads do not import mmseg.
+    ckpt_file = checkpoint_store.resolve(ckpt_file)
+    folder = os.path.join(EXPORT_FOLDER, export_key(cfg_file, ckpt_file))
+    exporter = Exporter(cfg_file, ckpt_file, folder)
+    if backend == "onnxruntime":
+        return OnnxRuntimeSegmentor(exporter, **options)
+    elif backend == "openvino":
+        return OpenVinoSegmentor(exporter, **options)
+    else:
+        raise Exception(f"Unknown backend {backend}. Available backends are {', '.join(BACKENDS)}")
@@ -0,0 +1,278 @@
+# Copyright (C) 2021 Ikomia SAS
+# Contact: https://www.ikomia.com
+#
+# This file is part of the IkomiaStudio software.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import argparse
+import csv
+import fnmatch
+import json
+import multiprocessing
+import platform
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from infer_mmlab_segmentation import zoo_index
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+_CSV_FIELDS = ["model_name", "model_config", "resolution", "batch_size", "load_time_s", "first_latency_ms",
+               "mean_ms", "p50_ms", "p90_ms", "p99_ms", "throughput_ips", "peak_rss_mb", "error"]
+
+
+def select_models(patterns):
+    # "model_name/model_config" glob patterns, e.g. "segformer/*b0*" or "pspnet/*"
+    selected = []
+    for model_name, configs in zoo_index.get_index()["models"].items():
+        for model_config, entry in configs.items():
+            if not entry["weights"]:
+                continue
+
+            name = f"{model_name}/{model_config}"
+            if any(fnmatch.fnmatch(name, p) or fnmatch.fnmatch(model_name, p) for p in patterns):
+                selected.append((model_name, model_config))
+
+    return selected
+
+
+def percentile(values, q):
+    values = sorted(values)
+    k = (len(values) - 1) * q
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def _synchronize(device):
+    import torch
+
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def benchmark_model(model_name, model_config, device="cpu", batch_sizes=(1,), resolutions=((512, 512),),
+                    iterations=20, warmup=3, mmap_weights=False):
+    if iterations < 1:
+        raise Exception("At least one measured iteration is needed")
+
+    import numpy as np
+    from infer_mmlab_segmentation import checkpoint_store, inference
+
+    cfg_file, ckpt_file = zoo_index.get_paths(model_name, model_config)
+    # Resolve (and download) the checkpoint outside of the measured load time
+    ckpt_file = checkpoint_store.resolve(ckpt_file)
+
+    t0 = time.perf_counter()
+    model = inference.init_segmentor(cfg_file, ckpt_file, device, mmap_weights)
+    pipeline = inference.build_test_pipeline(model)
+    _synchronize(device)
+    load_time = time.perf_counter() - t0
+
+    rng = np.random.default_rng(0)
+    rows = []
+    for width, height in resolutions:
+        for batch_size in batch_sizes:
+            images = [rng.integers(0, 256, (height, width, 3), dtype=np.uint8) for _ in range(batch_size)]
+            timings = []
+            # First call at this resolution and batch size: cold for the first row, shape
+            # specific allocations and kernel selection for the next ones
+            first_latency = None
+            for i in range(warmup + iterations):
+                t0 = time.perf_counter()
+                inference.infer_batch(model, pipeline, images, batch_size)
+                _synchronize(device)
+                elapsed = time.perf_counter() - t0
+                if first_latency is None:
+                    first_latency = elapsed
+                if i >= warmup:
+                    timings.append(elapsed)
+
+            mean = sum(timings) / len(timings)
+            rows.append({
+                "model_name": model_name,
+                "model_config": model_config,
+                "resolution": f"{width}x{height}",
+                "batch_size": batch_size,
+                "load_time_s": round(load_time, 4),
+                "first_latency_ms": round(first_latency * 1000, 2),
+                "mean_ms": round(mean * 1000, 2),
+                "p50_ms": round(percentile(timings, 0.5) * 1000, 2),
+                "p90_ms": round(percentile(timings, 0.9) * 1000, 2),
+                "p99_ms": round(percentile(timings, 0.99) * 1000, 2),
+                "throughput_ips": round(batch_size / mean, 2),
+            })
+
+    rss = peak_rss_mb()
+    for row in rows:
+        row["peak_rss_mb"] = round(rss, 1) if rss is not None else None
+
+    return rows
+
+
+def _benchmark_safe(model_name, model_config, kwargs):
+    try:
+        return benchmark_model(model_name, model_config, **kwargs)
+    except Exception:
+        return [{"model_name": model_name, "model_config": model_config, "error": traceback.format_exc(limit=3)}]
+
+
+def run(models, isolate=True, **kwargs):
+    # One fresh process per model (isolate=True): load time is a cold start and
+    # peak RSS is the one of this model only
+    rows = []
+    for model_name, model_config in models:
+        print(f"Benchmarking {model_name}/{model_config}...", file=sys.stderr)
+        if isolate:
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                rows.extend(executor.submit(_benchmark_safe, model_name, model_config, kwargs).result())
+        else:
+            rows.extend(_benchmark_safe(model_name, model_config, kwargs))
+
+    return rows
+
+
+def _row_key(row):
+    return row["model_name"], row["model_config"], row.get("resolution"), row.get("batch_size")
+
+
+def compare(rows, baseline_rows, tolerance=0.1):
+    # p50 latency ratio against a previous report, regressions above tolerance are flagged
+    baseline = {_row_key(r): r for r in baseline_rows if not r.get("error")}
+    comparison = []
+    for row in rows:
+        ref = baseline.get(_row_key(row))
+        if ref is None or row.get("error"):
+            continue
+
+        ratio = row["p50_ms"] / ref["p50_ms"] if ref["p50_ms"] else float("inf")
+        comparison.append({
+            "model_name": row["model_name"],
+            "model_config": row["model_config"],
+            "resolution": row["resolution"],
+            "batch_size": row["batch_size"],
+            "baseline_p50_ms": ref["p50_ms"],
+            "p50_ms": row["p50_ms"],
+            "ratio": round(ratio, 3),
+            "regression": ratio > 1 + tolerance,
+        })
+
+    return comparison
+
+
+def _environment():
+    env = {"python": platform.python_version(), "platform": platform.platform(), "processor": platform.processor()}
+    try:
+        import torch
+        import mmseg
+        env.update({"torch": torch.__version__, "mmseg": mmseg.__version__, "threads": torch.get_num_threads()})
+    except ImportError:
+        pass
+
+    return env
+
+
+def _parse_resolution(value):
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+def _at_least(minimum):
+    def parse(value):
+        value = int(value)
+        if value < minimum:
+            raise argparse.ArgumentTypeError(f"must be at least {minimum}")
+        return value
+
+    return parse
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark infer_mmlab_segmentation model zoo entries")
+    parser.add_argument("--models", nargs="+", default=["maskformer/maskformer_r50-d32_8xb2-160k_ade20k-512x512"],
+                        help="model_name or model_name/model_config glob patterns")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--batch-sizes", default="1", help="comma separated list, e.g. 1,2,4")
+    parser.add_argument("--resolutions", default="512x512", help="comma separated WIDTHxHEIGHT list")
+    parser.add_argument("--iterations", type=_at_least(1), default=20)
+    parser.add_argument("--warmup", type=_at_least(0), default=3)
+    parser.add_argument("--mmap-weights", action="store_true")
+    parser.add_argument("--no-isolation", action="store_true", help="run every model in the current process")
+    parser.add_argument("--output", default="benchmark.json", help="JSON report")
+    parser.add_argument("--csv", help="optional CSV report")
+    parser.add_argument("--baseline", help="previous JSON report to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed p50 latency increase vs baseline")
+    args = parser.parse_args()
+
+    models = select_models(args.models)
+    if not models:
+        parser.error(f"No model zoo entry matches {args.models}")
+
+    rows = run(models,
+               isolate=not args.no_isolation,
+               device=args.device,
+               batch_sizes=[int(b) for b in args.batch_sizes.split(",")],
+               resolutions=[_parse_resolution(r) for r in args.resolutions.split(",")],
+               iterations=args.iterations,
+               warmup=args.warmup,
+               mmap_weights=args.mmap_weights)
+
+    report = {"environment": _environment(), "device": args.device, "results": rows}
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            report["comparison"] = compare(rows, json.load(f)["results"], args.tolerance)
+        regressions = [c for c in report["comparison"] if c["regression"]]
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    if args.csv:
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=_CSV_FIELDS, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(rows)
+
+    for row in rows:
+        if row.get("error"):
+            print(f"{row['model_name']}/{row['model_config']}: FAILED\n{row['error']}")
+        else:
+            print(f"{row['model_name']}/{row['model_config']} {row['resolution']} bs={row['batch_size']}: "
+                  f"load {row['load_time_s']}s, p50 {row['p50_ms']}ms, p99 {row['p99_ms']}ms, "
+                  f"{row['throughput_ips']} img/s, peak RSS {row['peak_rss_mb']} MB")
+
+    for c in regressions:
+        print(f"REGRESSION {c['model_name']}/{c['model_config']} {c['resolution']} bs={c['batch_size']}: "
+              f"p50 {c['baseline_p50_ms']}ms -> {c['p50_ms']}ms (x{c['ratio']})")
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
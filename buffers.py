@@ -0,0 +1,146 @@
+# Copyright (C) 2021 Ikomia SAS
+# Contact: https://www.ikomia.com
+#
+# This file is part of the IkomiaStudio software.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import cv2
+import numpy as np
+import torch
+
+from infer_mmlab_segmentation import inference, postprocess, profiling
+
+# Pipelines the fast path reproduces exactly: load, optional cv2 bilinear resize, pack
+_SUPPORTED_TRANSFORMS = ["LoadImageFromNDArray", "Resize", "PackSegInputs"]
+
+
+def is_supported_pipeline(pipeline):
+    names = [type(t).__name__ for t in pipeline.transforms]
+    if [n for n in _SUPPORTED_TRANSFORMS if n in names] != names:
+        return False
+
+    for t in pipeline.transforms:
+        if type(t).__name__ == "Resize":
+            if getattr(t, "interpolation", "bilinear") != "bilinear" or getattr(t, "backend", "cv2") != "cv2":
+                return False
+        elif type(t).__name__ == "LoadImageFromNDArray" and getattr(t, "to_float32", False):
+            return False
+
+    return True
+
+
+class _Slot:
+
+    def __init__(self, template, pin_memory):
+        data_samples = template["data_samples"]
+        img_h, img_w = data_samples[0].metainfo["img_shape"][:2]
+        ori_h, ori_w = data_samples[0].metainfo["ori_shape"][:2]
+        device = template["inputs"].device
+        # Resized image, written in place by cv2 (pinned so that the upload can be asynchronous)
+        self.host = torch.empty((img_h, img_w, 3), dtype=torch.uint8, pin_memory=pin_memory)
+        self.resized = self.host.numpy()
+        self.device_image = self.host if device.type == "cpu" else torch.empty_like(self.host, device=device)
+        # Normalized batch, the padding area keeps the values computed by SegDataPreProcessor
+        self.inputs = template["inputs"].clone()
+        self.data = {"inputs": self.inputs, "data_samples": data_samples}
+        self.output = np.empty((ori_h, ori_w), dtype=np.uint8)
+
+
+class FixedShapeBuffers:
+    # Buffers allocated once for a stream of images of constant shape: resized image,
+    # pinned upload buffer, normalized input batch and output mask are reused from one
+    # call to the next, and reallocated when the input shape changes.
+    # Several slots are used round robin when calls overlap (streaming).
+    # Returned masks are reused buffers: copy them to keep them beyond `slots` calls.
+
+    def __init__(self, model, pipeline, slots=1, stable_after=2):
+        self.model = model
+        self.pipeline = pipeline
+        self.num_slots = max(1, slots)
+        self.stable_after = stable_after
+        self.supported = is_supported_pipeline(pipeline)
+        self.shape = None
+        self.count = 0
+        self.slots = []
+        self.next_slot = 0
+        self._init_normalization()
+
+    def _init_normalization(self):
+        preprocessor = self.model.data_preprocessor
+        self.channel_order = [2, 1, 0] if getattr(preprocessor, "channel_conversion", False) else [0, 1, 2]
+        self.normalize = getattr(preprocessor, "_enable_normalize", False)
+        if self.normalize:
+            self.mean = preprocessor.mean
+            self.std = preprocessor.std
+
+    def _track(self, image):
+        # True once the input shape has been stable for stable_after calls
+        if image.shape != self.shape:
+            self.shape = image.shape
+            self.count = 0
+            self.slots = []
+            self.next_slot = 0
+
+        self.count += 1
+        # Buffers hold 3 channel uint8 images: cv2 would reallocate dst for anything else
+        fits = image.ndim == 3 and image.shape[2] == 3 and image.dtype == np.uint8
+        return self.supported and fits and self.count >= self.stable_after
+
+    def _allocate(self, image):
+        # One regular pass gives the exact resize shape, padding and meta information
+        template = inference.prepare_batch(self.model, self.pipeline, [image])
+        pin_memory = template["inputs"].device.type == "cuda"
+        self.slots = [_Slot(template, pin_memory) for _ in range(self.num_slots)]
+
+    def prepare(self, image):
+        if not self._track(image):
+            return inference.prepare_batch(self.model, self.pipeline, [image])
+
+        if not self.slots:
+            self._allocate(image)
+
+        slot = self.slots[self.next_slot]
+        self.next_slot = (self.next_slot + 1) % self.num_slots
+
+        img_h, img_w = slot.resized.shape[:2]
+        if image.shape[:2] == (img_h, img_w):
+            slot.resized[...] = image
+        else:
+            cv2.resize(image, (img_w, img_h), dst=slot.resized, interpolation=cv2.INTER_LINEAR)
+
+        if slot.device_image is not slot.host:
+            slot.device_image.copy_(slot.host, non_blocking=True)
+
+        # Same as SegDataPreProcessor: channel conversion, float, normalization. No allocation.
+        view = slot.inputs[0, :, :img_h, :img_w]
+        for dst_c, src_c in enumerate(self.channel_order):
+            view[dst_c].copy_(slot.device_image[:, :, src_c])
+
+        if self.normalize:
+            view.sub_(self.mean).div_(self.std)
+
+        return slot.data
+
+    def masks(self, logits, data):
+        slot = next((s for s in self.slots if s.data is data), None)
+        outs = [slot.output] if slot is not None else None
+        return postprocess.masks_from_logits(self.model, logits, data["data_samples"], outs=outs)
+
+    def infer(self, image, timer=None):
+        with profiling.stage(timer, "prepare"):
+            data = self.prepare(image)
+        with profiling.stage(timer, "forward"):
+            logits = inference.predict_logits(self.model, data)
+        with profiling.stage(timer, "postprocess"):
+            return self.masks(logits, data)[0]
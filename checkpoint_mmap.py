@@ -0,0 +1,68 @@
+# Copyright (C) 2021 Ikomia SAS
+# Contact: https://www.ikomia.com
+#
+# This file is part of the IkomiaStudio software.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+
+import torch
+from mmseg.apis import init_model
+
+from infer_mmlab_segmentation import checkpoint_store
+
+
+def mmap_path(ckpt_file):
+    return checkpoint_store.derived_path(ckpt_file, checkpoint_store.MMAP_SUFFIX)
+
+
+def is_up_to_date(ckpt_file):
+    path = mmap_path(ckpt_file)
+    return os.path.isfile(path) and os.path.getmtime(path) >= os.path.getmtime(ckpt_file)
+
+
+def convert(model, ckpt_file):
+    # Flat state dict (no optimizer state, no module prefix) + dataset meta,
+    # saved in the zip format that torch.load() can memory-map
+    path = mmap_path(ckpt_file)
+    state_dict = {k: v.detach().cpu().contiguous() for k, v in model.state_dict().items()}
+    meta = {"dataset_meta": {k: list(v) if isinstance(v, tuple) else v for k, v in model.dataset_meta.items()}}
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    torch.save({"state_dict": state_dict, "meta": meta}, tmp_file)
+    os.replace(tmp_file, path)
+    return path
+
+
+def init_model_mmap(config, ckpt_file, device="cpu"):
+    # init_model() with parameters backed by a memory-mapped file: worker processes
+    # on the same host share the page cache instead of each holding a private copy.
+    # The first call converts the checkpoint with the regular loading path.
+    if not os.path.isfile(ckpt_file):
+        return init_model(config, ckpt_file, device=device)
+
+    if not is_up_to_date(ckpt_file):
+        model = init_model(config, ckpt_file, device="cpu")
+        try:
+            convert(model, ckpt_file)
+        except OSError:
+            # Read-only location: keep the regular loading path
+            pass
+        return model.to(device)
+
+    checkpoint = torch.load(mmap_path(ckpt_file), map_location="cpu", mmap=True, weights_only=True)
+    model = init_model(config, None, device="cpu")
+    # assign=True keeps the mmap-backed tensors instead of copying them into the parameters
+    model.load_state_dict(checkpoint["state_dict"], strict=True, assign=True)
+    model.dataset_meta = checkpoint["meta"]["dataset_meta"]
+    return model.to(device).eval()
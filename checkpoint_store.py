@@ -0,0 +1,356 @@
+# Copyright (C) 2021 Ikomia SAS
+# Contact: https://www.ikomia.com
+#
+# This file is part of the IkomiaStudio software.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import argparse
+import contextlib
+import copy
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+import time
+from urllib.parse import urlparse
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: no inter-process lock, index writes stay atomic
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+STORE_VERSION = 1
+
+_plugin_folder = os.path.dirname(os.path.abspath(__file__))
+_store_folder = os.environ.get("IKOMIA_MMSEG_CHECKPOINT_STORE", os.path.join(_plugin_folder, "models", "store"))
+_blobs_folder = os.path.join(_store_folder, "blobs")
+_index_file = os.path.join(_store_folder, "index.json")
+_lock_file = os.path.join(_store_folder, "index.lock")
+# Checkpoints downloaded by torch.hub before the store existed
+_legacy_folder = os.path.join(_plugin_folder, "models", "checkpoints")
+
+# Files written next to a checkpoint (memory-mapped copy, INT8 model calibrated from it):
+# counted in the disk budget and removed with the checkpoint
+MMAP_SUFFIX = ".mmap.pth"
+INT8_STATIC_SUFFIX = ".int8_static.pth"
+DERIVED_SUFFIXES = (MMAP_SUFFIX, INT8_STATIC_SUFFIX)
+
+# Disk budget in MB, 0 means unlimited
+DISK_BUDGET_MB = int(os.environ.get("IKOMIA_MMSEG_CHECKPOINT_STORE_MB", 0))
+# Never try to download, only resolve from the store
+OFFLINE = os.environ.get("IKOMIA_MMSEG_OFFLINE", "0").lower() in ("1", "true", "yes")
+
+# Resolution of the last use of a checkpoint for eviction, in seconds: cache hits
+# within this delay do not rewrite the index
+LAST_USED_RESOLUTION = 3600
+
+# OpenMMLab checkpoint names end with the first 8 hex digits of their sha256
+_hash_prefix_pattern = re.compile(r"-([a-f0-9]{8,})\.pth$")
+
+
+def is_url(path):
+    return urlparse(path).scheme in ("http", "https")
+
+
+def sha256sum(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def _blob_path(sha):
+    return os.path.join(_blobs_folder, f"{sha}.pth")
+
+
+def derived_path(ckpt_file, suffix):
+    return os.path.splitext(ckpt_file)[0] + suffix
+
+
+def _derived_files(ckpt_file):
+    return [f for f in (derived_path(ckpt_file, suffix) for suffix in DERIVED_SUFFIXES) if os.path.isfile(f)]
+
+
+def _disk_size(sha, blob):
+    return blob["size"] + sum(os.path.getsize(f) for f in _derived_files(_blob_path(sha)))
+
+
+def _empty_index():
+    return {"version": STORE_VERSION, "urls": {}, "blobs": {}}
+
+
+def _read_index():
+    try:
+        with open(_index_file, "r") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return _empty_index()
+
+    if index.get("version") != STORE_VERSION:
+        return _empty_index()
+
+    return index
+
+
+def _write_index(index):
+    tmp_file = f"{_index_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp_file, _index_file)
+
+
+@contextlib.contextmanager
+def _locked_index():
+    # Read-modify-write of the index, serialized between worker processes.
+    # Written back only when modified.
+    os.makedirs(_blobs_folder, exist_ok=True)
+    with open(_lock_file, "a") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            index = _read_index()
+            original = copy.deepcopy(index)
+            yield index
+            if index != original:
+                _write_index(index)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _check_integrity(url, sha):
+    match = _hash_prefix_pattern.search(os.path.basename(urlparse(url).path))
+    if match is not None and not sha.startswith(match.group(1)):
+        raise Exception(f"Checkpoint integrity check failed for {url}: sha256 {sha} does not match")
+
+
+def _add_blob(index, src_file, filename, move=False, sha=None):
+    # Store a file under its sha256; identical content is only kept once
+    sha = sha or sha256sum(src_file)
+    blob = _blob_path(sha)
+    if not os.path.isfile(blob):
+        tmp_file = f"{blob}.{os.getpid()}.tmp"
+        if move:
+            shutil.move(src_file, tmp_file)
+        else:
+            shutil.copyfile(src_file, tmp_file)
+        os.replace(tmp_file, blob)
+    elif move:
+        os.remove(src_file)
+
+    index["blobs"][sha] = {
+        "size": os.path.getsize(blob),
+        "filename": filename,
+        "last_used": time.time(),
+    }
+    return sha
+
+
+def _add_checkpoint(index, src_file, urls, move=False, sha=None):
+    filename = os.path.basename(urlparse(urls[0]).path)
+    sha = _add_blob(index, src_file, filename, move=move, sha=sha)
+    try:
+        _check_integrity(urls[0], sha)
+    except Exception:
+        if not any(s == sha for s in index["urls"].values()):
+            os.remove(_blob_path(sha))
+            del index["blobs"][sha]
+        raise
+
+    for url in urls:
+        index["urls"][url] = sha
+
+    return sha
+
+
+def _lookup(index, url):
+    sha = index["urls"].get(url)
+    if sha is None or sha not in index["blobs"]:
+        return None
+
+    blob = _blob_path(sha)
+    if not os.path.isfile(blob) or os.path.getsize(blob) != index["blobs"][sha]["size"]:
+        return None
+
+    now = time.time()
+    if now - index["blobs"][sha]["last_used"] > LAST_USED_RESOLUTION:
+        index["blobs"][sha]["last_used"] = now
+    return blob
+
+
+def _evict(index, keep):
+    if DISK_BUDGET_MB <= 0:
+        return
+
+    budget = DISK_BUDGET_MB * 1024 * 1024
+    sizes = {sha: _disk_size(sha, blob) for sha, blob in index["blobs"].items()}
+    total = sum(sizes.values())
+    for sha, blob in sorted(index["blobs"].items(), key=lambda item: item[1]["last_used"]):
+        if total <= budget:
+            break
+        if sha == keep:
+            continue
+
+        for f in [_blob_path(sha)] + _derived_files(_blob_path(sha)):
+            with contextlib.suppress(OSError):
+                os.remove(f)
+        total -= sizes[sha]
+        del index["blobs"][sha]
+        index["urls"] = {u: s for u, s in index["urls"].items() if s != sha}
+
+
+def _download(url):
+    # Unique file name: the same checkpoint may be downloaded by several threads or processes
+    from torch.hub import download_url_to_file
+
+    fd, tmp_file = tempfile.mkstemp(suffix=".download.tmp", dir=_blobs_folder)
+    os.close(fd)
+    try:
+        download_url_to_file(url, tmp_file, progress=True)
+    except Exception:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_file)
+        raise
+
+    return tmp_file
+
+
+def resolve(url):
+    # URL -> local checkpoint path. Local paths are returned unchanged and the
+    # network is only used when the checkpoint is not in the store yet.
+    if not is_url(url):
+        return url
+
+    with _locked_index() as index:
+        blob = _lookup(index, url)
+        if blob is not None:
+            return blob
+
+        legacy_file = os.path.join(_legacy_folder, os.path.basename(urlparse(url).path))
+        if os.path.isfile(legacy_file):
+            sha = _add_checkpoint(index, legacy_file, [url], move=True)
+            _evict(index, keep=sha)
+            return _blob_path(sha)
+        elif OFFLINE:
+            raise Exception(f"Checkpoint {url} is not in the local store {_store_folder} and offline mode is set. "
+                            f"Seed the store with: python -m infer_mmlab_segmentation.checkpoint_store seed <path>")
+
+    # Download and hash without the lock: other checkpoints stay available meanwhile
+    tmp_file = _download(url)
+    try:
+        sha = sha256sum(tmp_file)
+        with _locked_index() as index:
+            # Stored by another process during the download
+            blob = _lookup(index, url)
+            if blob is not None:
+                return blob
+
+            sha = _add_checkpoint(index, tmp_file, [url], move=True, sha=sha)
+            _evict(index, keep=sha)
+            return _blob_path(sha)
+    finally:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_file)
+
+
+def _known_urls():
+    # Checkpoint file name -> model zoo URLs
+    from infer_mmlab_segmentation import zoo_index
+
+    urls = {}
+    for configs in zoo_index.get_index()["models"].values():
+        for entry in configs.values():
+            if entry["weights"]:
+                urls.setdefault(os.path.basename(urlparse(entry["weights"]).path), []).append(entry["weights"])
+
+    return urls
+
+
+def seed(path):
+    # Import checkpoints from a directory or a tarball (air-gapped hosts).
+    # Files are matched to model zoo URLs by file name and checked against their hash.
+    known_urls = _known_urls()
+    seeded = []
+
+    def _import(index, src_file, filename, move):
+        urls = known_urls.get(filename, [])
+        if not urls:
+            return
+
+        try:
+            _add_checkpoint(index, src_file, urls, move=move)
+        except Exception as e:
+            logger.warning(f"Checkpoint {filename} not imported: {e}")
+            return
+
+        seeded.append(filename)
+
+    with _locked_index() as index:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for filename in files:
+                    if filename.endswith(".pth"):
+                        _import(index, os.path.join(root, filename), filename, move=False)
+        elif tarfile.is_tarfile(path):
+            with tarfile.open(path) as tar:
+                for member in tar:
+                    filename = os.path.basename(member.name)
+                    if not member.isfile() or filename not in known_urls:
+                        continue
+
+                    tmp_file = os.path.join(_blobs_folder, f"seed.{os.getpid()}.tmp")
+                    try:
+                        with tar.extractfile(member) as src, open(tmp_file, "wb") as dst:
+                            shutil.copyfileobj(src, dst, 1024 * 1024)
+                        _import(index, tmp_file, filename, move=True)
+                    finally:
+                        # Moved into the store unless the import failed
+                        with contextlib.suppress(OSError):
+                            os.remove(tmp_file)
+        else:
+            raise Exception(f"{path} is neither a directory nor a tar archive")
+
+        _evict(index, keep=None)
+
+    return seeded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the local checkpoint store of infer_mmlab_segmentation")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    seed_parser = subparsers.add_parser("seed", help="import checkpoints from a directory or a tarball")
+    seed_parser.add_argument("path")
+    subparsers.add_parser("list", help="list stored checkpoints")
+    args = parser.parse_args()
+
+    if args.command == "seed":
+        for filename in seed(args.path):
+            print(filename)
+    else:
+        index = _read_index()
+        for url, sha in sorted(index["urls"].items()):
+            print(f"{sha[:12]}  {index['blobs'].get(sha, {}).get('size', 0):>12}  {url}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+# Copyright (C) 2021 Ikomia SAS
+# Contact: https://www.ikomia.com
+#
+# This file is part of the IkomiaStudio software.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import hashlib
+import logging
+import os
+import threading
+import warnings
+from collections import OrderedDict
+
+import torch
+
+from infer_mmlab_segmentation import backends
+from infer_mmlab_segmentation.export import LogitsModel
+
+logger = logging.getLogger(__name__)
+
+COMPILE_MODES = ["none", "torchscript", "inductor"]
+_plugin_folder = os.path.dirname(os.path.abspath(__file__))
+COMPILE_FOLDER = os.environ.get("IKOMIA_MMSEG_COMPILE_FOLDER", os.path.join(_plugin_folder, "models", "compile"))
+# Traced graphs kept in memory when they are shape specific
+MAX_TRACED_SHAPES = 8
+
+
+def model_signature(model):
+    # Module types, dtypes and shapes of the state dict, values of quantization parameters:
+    # INT8 and BatchNorm folded / channels_last variants of a model do not share their traces
+    h = hashlib.sha1()
+    for name, module in model.named_modules():
+        h.update(f"{name}:{type(module).__name__};".encode())
+
+    for name, value in model.state_dict().items():
+        if torch.is_tensor(value):
+            h.update(f"{name}:{value.dtype}:{tuple(value.shape)}:{value.is_contiguous()};".encode())
+            if name.endswith(("scale", "zero_point")):
+                h.update(value.detach().cpu().numpy().tobytes())
+        else:
+            h.update(f"{name}:{type(value).__name__};".encode())
+
+    return h.hexdigest()[:8]
+
+
+def cache_folder(cfg_file, ckpt_file, device, model, precision="fp32", cpu_optimization=False):
+    # Traced graphs depend on the model and its precision and CPU optimizations, the device type
+    # and the torch version
+    key = backends.export_key(cfg_file, ckpt_file)
+    device_type = torch.device(device).type
+    variant = f"{precision}{'_cpuopt' if cpu_optimization else ''}_{model_signature(model)}"
+    return os.path.join(COMPILE_FOLDER, f"{key}_{device_type}_{variant}_torch{torch.__version__.split('+')[0]}")
+
+
+def dynamic_shapes(pipeline):
+    # Input shapes only vary with the image size when Resize keeps the aspect ratio
+    for t in pipeline.transforms:
+        if type(t).__name__ == "Resize":
+            return t.scale is None or t.keep_ratio
+
+    return True
+
+
+class CompiledEncodeDecode:
+    # Replacement of EncoderDecoder.encode_decode(): backbone, neck and decode head compiled
+    # as one graph returning logits at input size, like decode_head.predict(). Every inference
+    # path (whole, slide, tiles, fixed buffers) goes through encode_decode().
+    # The first failure restores the eager method: compilation errors only show up on the first
+    # call (unsupported operators, heads needing data samples like mask2former, no C++ compiler...).
+
+    def __init__(self, model, mode, folder, dynamic):
+        self.model = model
+        self.mode = mode
+        self.folder = folder
+        self.dynamic = dynamic
+        self.eager = model.encode_decode
+        self.logits = LogitsModel(model).eval()
+        self.failed = False
+        self._lock = threading.Lock()
+        self._traced = OrderedDict()
+        self._compiled = None
+
+    def __call__(self, inputs, batch_img_metas):
+        if not self.failed:
+            try:
+                if self.mode == "torchscript":
+                    return self._torchscript(inputs)
+                return self._inductor(inputs)
+            except Exception as e:
+                logger.warning(f"{self.mode} compilation failed, falling back to eager mode: {e}")
+                self.failed = True
+                self.model.encode_decode = self.eager
+
+        return self.eager(inputs, batch_img_metas)
+
+    def _trace_file(self, shape):
+        name = "model" if shape is None else "model_" + "x".join(str(s) for s in shape)
+        return os.path.join(self.folder, f"{name}.pt")
+
+    def _trace(self, inputs):
+        # Shape independent graph unless tracing reports Python values computed from shapes
+        with warnings.catch_warnings(record=True) as caught, torch.no_grad():
+            warnings.simplefilter("always", torch.jit.TracerWarning)
+            module = torch.jit.trace(self.logits, (inputs,), check_trace=False)
+        shape_free = not any(issubclass(w.category, torch.jit.TracerWarning) for w in caught)
+        trace_file = self._trace_file(None if shape_free else tuple(inputs.shape))
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            tmp_file = f"{trace_file}.{os.getpid()}.tmp"
+            torch.jit.save(module, tmp_file)
+            os.replace(tmp_file, trace_file)
+        except OSError:
+            logger.warning(f"Unable to save traced model in {self.folder}")
+
+        return module, shape_free
+
+    def _torchscript(self, inputs):
+        shape = tuple(inputs.shape)
+        with self._lock:
+            module = self._traced.get(None, self._traced.get(shape))
+            if module is None:
+                device = inputs.device
+                if os.path.isfile(self._trace_file(None)):
+                    key, module = None, torch.jit.load(self._trace_file(None), map_location=device)
+                elif os.path.isfile(self._trace_file(shape)):
+                    key, module = shape, torch.jit.load(self._trace_file(shape), map_location=device)
+                else:
+                    module, shape_free = self._trace(inputs)
+                    key = None if shape_free else shape
+
+                self._traced[key] = module
+                if len(self._traced) > MAX_TRACED_SHAPES:
+                    self._traced.popitem(last=False)
+            else:
+                self._traced.move_to_end(None if None in self._traced else shape)
+
+        return module(inputs)
+
+    def _inductor(self, inputs):
+        with self._lock:
+            if self._compiled is None:
+                # Inductor FX graph and kernel caches persist compiled code between processes
+                os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.join(COMPILE_FOLDER, "inductor"))
+                self._compiled = torch.compile(self.logits, dynamic=self.dynamic)
+
+        return self._compiled(inputs)
+
+
+def apply(model, pipeline, mode, folder):
+    if mode == "none":
+        return model
+
+    if mode not in COMPILE_MODES:
+        raise Exception(f"Unknown compile mode {mode}. Available modes are {', '.join(COMPILE_MODES)}")
+
+    if type(model).__name__ != "EncoderDecoder" or isinstance(model.decode_head, torch.nn.ModuleList):
+        logger.warning(f"{type(model).__name__} models are not compiled, running in eager mode")
+        return model
+
+    model.encode_decode = CompiledEncodeDecode(model, mode, folder, dynamic_shapes(pipeline))
+    return model
@@ -0,0 +1,119 @@
+# Copyright (C) 2021 Ikomia SAS
+# Contact: https://www.ikomia.com
+#
+# This file is part of the IkomiaStudio software.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import copy
+import hashlib
+import os
+import pickle
+import threading
+
+import mmengine
+from mmengine.config import Config
+from mmengine.utils import import_modules_from_strings
+
+from infer_mmlab_segmentation import zoo_index
+
+# Bump when the content of cached configs changes
+CONFIG_CACHE_VERSION = 1
+
+_plugin_folder = os.path.dirname(os.path.abspath(__file__))
+CONFIG_FOLDER = os.environ.get("IKOMIA_MMSEG_CONFIG_FOLDER", os.path.join(_plugin_folder, "models", "config_cache"))
+
+# Sections needed to build the model and its test pipeline. Dataloaders, optimizer, schedules,
+# hooks, visualizer... only matter for training and are not kept.
+TEST_SECTIONS = ("default_scope", "custom_imports", "model", "test_pipeline", "tta_pipeline", "tta_model",
+                 "test_dataloader")
+
+_lock = threading.Lock()
+# Absolute config path -> (stat of every file of the _base_ chain, test config dict)
+_memo = {}
+
+
+def _stamps(files):
+    stamps = []
+    for f in files:
+        st = os.stat(f)
+        stamps.append((f, st.st_mtime_ns, st.st_size))
+
+    return tuple(stamps)
+
+
+def cache_key(files):
+    # Content of the config and of all its parents: edited configs give a new entry
+    h = hashlib.sha1(f"{CONFIG_CACHE_VERSION}:{mmengine.__version__}".encode())
+    for f in files:
+        with open(f, "rb") as fp:
+            h.update(fp.read())
+
+    return h.hexdigest()[:16]
+
+
+def test_config(cfg):
+    # Fully merged config -> plain dict of the test sections
+    cfg_dict = cfg.to_dict()
+    return {k: cfg_dict[k] for k in TEST_SECTIONS if k in cfg_dict}
+
+
+def _read(cache_file):
+    try:
+        with open(cache_file, "rb") as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        return None
+
+
+def _write(cache_file, cfg_dict):
+    try:
+        os.makedirs(CONFIG_FOLDER, exist_ok=True)
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as f:
+            pickle.dump(cfg_dict, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except (OSError, pickle.PicklingError, TypeError, AttributeError):
+        # Read-only folder or values that cannot be pickled: resolved again next time
+        pass
+
+
+def load_config(cfg_file):
+    # mmengine Config of cfg_file with its _base_ inheritance resolved, test sections only.
+    # Resolved configs are kept in memory (checked with stat() calls only) and on disk
+    # (checked with the content of the whole chain), Config.fromfile() runs once per config.
+    cfg_file = os.path.abspath(cfg_file)
+    with _lock:
+        cached = _memo.get(cfg_file)
+        if cached is not None:
+            stamps, cfg_dict = cached
+            try:
+                if _stamps([s[0] for s in stamps]) == stamps:
+                    return Config(copy.deepcopy(cfg_dict), filename=cfg_file)
+            except OSError:
+                pass
+
+        # Parents outside the plugin (package scope, missing files) are left to mmengine
+        files = [f for f in zoo_index.config_chain(cfg_file) if os.path.isfile(f)]
+        stamps = _stamps(files)
+        cache_file = os.path.join(CONFIG_FOLDER, f"{cache_key(files)}.pkl")
+        cfg_dict = _read(cache_file)
+        if cfg_dict is None:
+            cfg_dict = test_config(Config.fromfile(cfg_file))
+            _write(cache_file, cfg_dict)
+        elif "custom_imports" in cfg_dict:
+            # Done by Config.fromfile(): modules registering components of other OpenMMLab packages
+            import_modules_from_strings(**cfg_dict["custom_imports"])
+
+        _memo[cfg_file] = (stamps, cfg_dict)
+        return Config(copy.deepcopy(cfg_dict), filename=cfg_file)
@@ -0,0 +1,79 @@
+# Copyright (C) 2021 Ikomia SAS
+# Contact: https://www.ikomia.com
+#
+# This file is part of the IkomiaStudio software.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import copy
+import logging
+
+import numpy as np
+import torch
+
+from infer_mmlab_segmentation import inference
+
+logger = logging.getLogger(__name__)
+
+# Max absolute logits difference after optimization, relative to the logits magnitude
+VERIFY_TOLERANCE = 1e-3
+VERIFY_SIZE = 512
+
+
+def fold_batchnorm(model):
+    # BatchNorm / SyncBN following a convolution merged into its weights and bias (eval mode only).
+    # mmcv pairs each norm layer with the convolution registered just before it, which holds for
+    # ConvModule and ResNet / HRNet blocks; verify() catches architectures where it does not.
+    from mmcv.cnn import fuse_conv_bn
+
+    return fuse_conv_bn(model)
+
+
+def _channels_last_inputs(_module, args):
+    return tuple(a.contiguous(memory_format=torch.channels_last) if torch.is_tensor(a) and a.dim() == 4 else a
+                 for a in args)
+
+
+def to_channels_last(model):
+    # NHWC weights, and inputs converted when entering the backbone: oneDNN convolutions
+    # then run without layout reorders between layers
+    model.to(memory_format=torch.channels_last)
+    model.backbone.register_forward_pre_hook(_channels_last_inputs)
+    return model
+
+
+def _verify_batch(model, pipeline):
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, (VERIFY_SIZE, VERIFY_SIZE, 3), dtype=np.uint8)
+    return inference.prepare_batch(model, pipeline, [image])
+
+
+def verify(reference, model, data, tolerance=VERIFY_TOLERANCE):
+    expected = inference.predict_logits(reference, data)
+    logits = inference.predict_logits(model, data)
+    error = (logits - expected).abs().max().item()
+    return error <= tolerance * max(1.0, expected.abs().max().item()), error
+
+
+def optimize(model, pipeline, check=True):
+    # Optimized copy of the model, or the model itself if the optimized outputs differ
+    optimized = fold_batchnorm(copy.deepcopy(model))
+    optimized = to_channels_last(optimized)
+    if check:
+        ok, error = verify(model, optimized, _verify_batch(model, pipeline))
+        if not ok:
+            logger.warning(f"Optimized model differs from the original one (max error {error:.2e}), "
+                           f"running the original model")
+            return model
+
+    return optimized
@@ -0,0 +1,420 @@
+# Copyright (C) 2021 Ikomia SAS
+# Contact: https://www.ikomia.com
+#
+# This file is part of the IkomiaStudio software.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import functools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import Future, InvalidStateError
+
+from infer_mmlab_segmentation import shm_transport
+
+# Module imported by worker processes before they are pinned: torch and mmseg are only
+# imported inside functions, once the process runs on its own cores.
+
+_READY_TIMEOUT = 600
+
+
+def load_replica(cfg_file, ckpt_file, device, mmap_weights=False, slide_batch_size=4):
+    # Model and test pipeline of one replica, picklable through functools.partial
+    from infer_mmlab_segmentation import inference, sliding
+
+    model = inference.init_segmentor(cfg_file, ckpt_file, device, mmap_weights)
+    model = sliding.apply(model, slide_batch_size)
+    return model, inference.build_test_pipeline(model)
+
+
+def make_loader(cfg_file, ckpt_file, mmap_weights=False, slide_batch_size=4):
+    return functools.partial(load_replica, cfg_file, ckpt_file, mmap_weights=mmap_weights,
+                             slide_batch_size=slide_batch_size)
+
+
+class _Runner:
+    # Inference on a loaded replica, pipelines built once per resolution
+
+    def __init__(self, model, pipeline):
+        self.model = model
+        self.pipelines = {1.0: pipeline}
+        self.classes = list(model.dataset_meta["classes"])
+
+    def infer(self, images, batch_size=1, scale=1.0, roi=None, resolution=1.0):
+        from infer_mmlab_segmentation import inference
+
+        pipeline = self.pipelines.get(resolution)
+        if pipeline is None:
+            pipeline = self.pipelines[resolution] = inference.build_test_pipeline(self.model, resolution)
+
+        return inference.infer_batch(self.model, pipeline, images, batch_size, scale, roi)
+
+
+class ModelReplica:
+    # Model loaded in the current process on one device (cuda:N, or cpu with torch threads)
+
+    def __init__(self, device, loader):
+        self.device = device
+        self.loader = loader
+        self.runner = None
+        self.classes = None
+
+    def start(self):
+        self.runner = _Runner(*self.loader(self.device))
+        self.classes = self.runner.classes
+
+    def wait_ready(self):
+        pass
+
+    def infer(self, images, **kwargs):
+        return self.runner.infer(images, **kwargs)
+
+    def send(self, images, **kwargs):
+        return self.infer(images, **kwargs)
+
+    def receive(self, ticket):
+        return ticket
+
+    def close(self):
+        self.runner = None
+
+
+def _pin(cpus, num_threads):
+    # Before torch is imported: OpenMP reads its thread count once
+    if cpus and hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, cpus)
+        except OSError as e:
+            raise Exception(f"Unable to pin worker process to cores {cpus}: {e}")
+
+    threads = num_threads or (len(cpus) if cpus else os.cpu_count())
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    import torch
+
+    torch.set_num_threads(threads)
+
+
+def _serve_request(runner, attachments, message):
+    # Images read from and masks written to the shared memory of the request slot
+    slot, inputs, input_items, outputs, output_items, kwargs = message
+    images = shm_transport.views(attachments.get(("inputs", slot), inputs), input_items)
+    masks = runner.infer(images, **kwargs)
+    for view, mask in zip(shm_transport.views(attachments.get(("outputs", slot), outputs), output_items), masks):
+        view[...] = mask
+
+    return slot
+
+
+def _worker_main(conn, loader, cpus, num_threads):
+    try:
+        _pin(cpus, num_threads)
+        runner = _Runner(*loader("cpu"))
+        conn.send(("ready", runner.classes))
+    except BaseException:
+        conn.send(("error", traceback.format_exc()))
+        return
+
+    attachments = shm_transport.Attachments()
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+
+        if message is None:
+            break
+
+        try:
+            conn.send(("ok", _serve_request(runner, attachments, message)))
+        except Exception:
+            conn.send(("error", traceback.format_exc()))
+
+    attachments.close()
+
+
+class ProcessReplica:
+    # Model loaded in a worker process pinned to a set of cores (NUMA node, core range...).
+    # Worker processes are spawned: no fork of a parent holding CUDA or OpenMP state.
+    # Images and masks are not pickled: they go through a ring of shared memory slots (one block
+    # for the images, one for the masks), only their layout is sent through the pipe. With depth
+    # slots, the next request is written while the worker computes the current one.
+
+    def __init__(self, cpus, loader, num_threads=0, depth=2):
+        self.device = "cpu"
+        self.cpus = list(cpus) if cpus else []
+        self.loader = loader
+        self.num_threads = num_threads
+        self.depth = max(1, depth)
+        self.classes = None
+        self.process = None
+        self.conn = None
+        self._slots = [(shm_transport.Arena(), shm_transport.Arena()) for _ in range(self.depth)]
+        self._output_items = [None] * self.depth
+        self._next_slot = 0
+
+    def start(self):
+        ctx = multiprocessing.get_context("spawn")
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn, self.loader, self.cpus, self.num_threads),
+                                   daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def _receive(self, timeout=None):
+        if timeout is not None and not self.conn.poll(timeout):
+            raise Exception(f"Worker process on cores {self.cpus} did not start within {timeout}s")
+        try:
+            status, result = self.conn.recv()
+        except EOFError:
+            raise Exception(f"Worker process on cores {self.cpus} exited (code {self.process.exitcode})")
+
+        if status == "error":
+            raise Exception(f"Worker process on cores {self.cpus} failed:\n{result}")
+        return result
+
+    def wait_ready(self):
+        self.classes = self._receive(_READY_TIMEOUT)
+
+    def send(self, images, **kwargs):
+        # Slots are used round robin: at most depth requests in flight, received in order
+        from infer_mmlab_segmentation import postprocess
+
+        slot = self._next_slot
+        self._next_slot = (slot + 1) % self.depth
+        inputs, outputs = self._slots[slot]
+        input_items = inputs.write(images)
+        scale, roi = kwargs.get("scale", 1.0), kwargs.get("roi", None)
+        output_items, nbytes = shm_transport.layout([(postprocess.output_shape(img.shape[:2], scale, roi), "uint8")
+                                                     for img in images])
+        outputs.reserve(nbytes)
+        self._output_items[slot] = output_items
+        self.conn.send((slot, inputs.name, input_items, outputs.name, output_items, kwargs))
+        return slot
+
+    def receive(self, slot):
+        self._receive()
+        return self._slots[slot][1].read(self._output_items[slot])
+
+    def infer(self, images, **kwargs):
+        return self.receive(self.send(images, **kwargs))
+
+    def close(self):
+        if self.process is not None:
+            try:
+                self.conn.send(None)
+            except (OSError, ValueError):
+                pass
+            self.process.join(timeout=5)
+            if self.process.is_alive():
+                self.process.terminate()
+            self.conn.close()
+            self.process = None
+
+        for inputs, outputs in self._slots:
+            inputs.close()
+            outputs.close()
+
+
+def make_replicas(replica_specs, loader, num_threads=0):
+    # devices.parse_devices() output -> replicas
+    return [ProcessReplica(cpus, loader, num_threads) if cpus else ModelReplica(device, loader)
+            for device, cpus in replica_specs]
+
+
+class DevicePool:
+    # Replicas of one model on several devices or core sets, each served by its own thread.
+    # Every image goes to the replica with the fewest pending images, queued images of a replica
+    # are batched (up to max_batch), and results come back through futures in submission order.
+
+    def __init__(self, replicas, max_batch=1):
+        if not replicas:
+            raise Exception("A device pool needs at least one replica")
+
+        self.replicas = replicas
+        self.max_batch = max(1, max_batch)
+        self._lock = threading.Lock()
+        self._pending = [0] * len(replicas)
+        self._next = 0
+        self._queues = [queue.Queue() for _ in replicas]
+        # Requests taken from a queue but left for the next batch
+        self._carried = [deque() for _ in replicas]
+        # Futures not completed yet, failed by close() if they cannot be served in time
+        self._futures = set()
+        self._closed = False
+        workers = [r for r in replicas if isinstance(r, ProcessReplica)]
+        # With several workers, the first one fills the caches of the others (downloaded checkpoint,
+        # memory-mapped weights, resolved config) instead of all of them writing the same files
+        first = workers[:1] if len(workers) > 1 else []
+        others = [r for r in replicas if r not in first]
+        try:
+            for replica in first:
+                replica.start()
+                replica.wait_ready()
+            # Worker processes load in parallel with in-process replicas
+            for replica in sorted(others, key=lambda r: not isinstance(r, ProcessReplica)):
+                replica.start()
+            for replica in others:
+                replica.wait_ready()
+        except BaseException:
+            for replica in replicas:
+                replica.close()
+            raise
+
+        self.classes = replicas[0].classes
+        self._threads = [threading.Thread(target=self._serve, args=(i,), daemon=True) for i in range(len(replicas))]
+        for t in self._threads:
+            t.start()
+
+    def _choose(self):
+        # Least pending images, ties broken round robin so that idle replicas share the work
+        n = len(self.replicas)
+        order = [(self._next + k) % n for k in range(n)]
+        i = min(order, key=lambda k: self._pending[k])
+        self._next = (i + 1) % n
+        return i
+
+    def submit(self, image, scale=1.0, roi=None, resolution=1.0):
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise Exception("The device pool is closed")
+            i = self._choose()
+            self._pending[i] += 1
+            self._futures.add(future)
+            # Under the lock: close() queues its end marker after every accepted request
+            self._queues[i].put((image, (scale, roi, resolution), future))
+
+        return future
+
+    def _take(self, i, block=True):
+        # First queued request, then those already waiting with the same options.
+        # None once the pool is closed, [] if nothing is queued and block is False.
+        q, carried = self._queues[i], self._carried[i]
+        if carried:
+            first = carried.popleft()
+        else:
+            try:
+                first = q.get(block)
+            except queue.Empty:
+                return []
+
+        if first is None:
+            return None
+
+        batch = [first]
+        while len(batch) < self.max_batch:
+            try:
+                item = q.get_nowait()
+            except queue.Empty:
+                break
+            if item is None or item[1] != first[1]:
+                # Served on the next round, in order
+                carried.append(item)
+                break
+            batch.append(item)
+
+        return batch
+
+    def _finish(self, i, batch, masks=None, error=None):
+        for k, item in enumerate(batch):
+            try:
+                if error is None:
+                    item[2].set_result(masks[k])
+                else:
+                    item[2].set_exception(error)
+            except InvalidStateError:
+                # Already failed by close()
+                pass
+
+        with self._lock:
+            self._pending[i] -= len(batch)
+            self._futures.difference_update(item[2] for item in batch)
+
+    def _serve(self, i):
+        # Up to replica.depth batches in flight: the next batch is sent before the previous
+        # one is received when the replica supports it (worker processes)
+        replica = self.replicas[i]
+        depth = getattr(replica, "depth", 1)
+        in_flight = deque()
+        closed = False
+        while not closed or in_flight:
+            if not closed and len(in_flight) < depth:
+                batch = self._take(i, block=not in_flight)
+                if batch is None:
+                    closed = True
+                    continue
+                if batch:
+                    scale, roi, resolution = batch[0][1]
+                    try:
+                        ticket = replica.send([item[0] for item in batch], batch_size=len(batch), scale=scale,
+                                              roi=roi, resolution=resolution)
+                        in_flight.append((batch, ticket))
+                    except Exception as e:
+                        self._finish(i, batch, error=e)
+                    continue
+
+            batch, ticket = in_flight.popleft()
+            try:
+                masks = replica.receive(ticket)
+            except Exception as e:
+                self._finish(i, batch, error=e)
+            else:
+                self._finish(i, batch, masks)
+
+    def infer_batch(self, images, batch_size=1, scale=1.0, roi=None, timer=None, resolution=1.0):
+        # Same contract as inference.infer_batch(): list of images -> list of masks in the same order
+        futures = [self.submit(img, scale, roi, resolution) for img in images]
+        return [f.result() for f in futures]
+
+    def map(self, images, max_in_flight=None):
+        # Generator over an iterable of images, masks yielded in order, at most
+        # max_in_flight images submitted ahead (default: 2 per replica)
+        max_in_flight = max_in_flight or 2 * len(self.replicas) * self.max_batch
+        futures = deque()
+        for image in images:
+            futures.append(self.submit(image))
+            if len(futures) >= max_in_flight:
+                yield futures.popleft().result()
+
+        while futures:
+            yield futures.popleft().result()
+
+    def close(self, timeout=None):
+        # Requests already submitted are served first. Those still pending after timeout seconds
+        # (None: no limit) fail explicitly before the replicas are torn down.
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            for q in self._queues:
+                q.put(None)
+
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        for t in self._threads:
+            t.join(timeout=None if deadline is None else max(0.0, deadline - time.monotonic()))
+
+        with self._lock:
+            futures, self._futures = self._futures, set()
+        for future in futures:
+            try:
+                future.set_exception(Exception("The device pool was closed before this request was served"))
+            except InvalidStateError:
+                pass
+
+        for replica in self.replicas:
+            replica.close()
@@ -0,0 +1,197 @@
+# Copyright (C) 2021 Ikomia SAS
+# Contact: https://www.ikomia.com
+#
+# This file is part of the IkomiaStudio software.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import contextlib
+
+import torch
+
+from infer_mmlab_segmentation import postprocess
+
+
+class _CompletedEvent:
+
+    def synchronize(self):
+        pass
+
+    def query(self):
+        return True
+
+
+class NullStreams:
+    # CPU counterpart of CudaStreams: work runs synchronously in the calling thread and events
+    # are always complete, so that the overlapped code path runs unchanged without GPU.
+    host_buffers = False
+
+    def stream(self):
+        return None
+
+    def use(self, stream):
+        return contextlib.nullcontext()
+
+    def record(self, stream):
+        return _CompletedEvent()
+
+    def wait(self, stream, event):
+        pass
+
+    def keep(self, tensor, stream):
+        pass
+
+    def empty(self, shape, dtype):
+        return torch.empty(shape, dtype=dtype)
+
+
+class CudaStreams:
+    # Side streams, events and pinned host buffers of one CUDA device
+    host_buffers = True
+
+    def __init__(self, device):
+        self.device = torch.device(device)
+
+    def stream(self):
+        return torch.cuda.Stream(self.device)
+
+    def use(self, stream):
+        return torch.cuda.stream(stream)
+
+    def record(self, stream):
+        event = torch.cuda.Event()
+        event.record(stream)
+        return event
+
+    def wait(self, stream, event):
+        stream.wait_event(event)
+
+    def keep(self, tensor, stream):
+        # Tensor allocated on one stream and used on another: the caching allocator must not
+        # reuse its memory before the work queued on that stream is done
+        tensor.record_stream(stream)
+
+    def empty(self, shape, dtype):
+        return torch.empty(shape, dtype=dtype, pin_memory=True)
+
+
+def for_device(device):
+    device = torch.device(device)
+    return CudaStreams(device) if device.type == "cuda" else NullStreams()
+
+
+class _HostRing:
+    # Pinned input buffers used round robin: a buffer is rewritten once its last upload is complete
+
+    def __init__(self, streams, size):
+        self.streams = streams
+        self.size = max(1, size)
+        self.key = None
+        self.buffers = []
+        self.events = []
+        self.next = 0
+
+    def acquire(self, shape, dtype):
+        if (shape, dtype) != self.key:
+            self.key = (shape, dtype)
+            self.buffers = [self.streams.empty(shape, dtype) for _ in range(self.size)]
+            self.events = [None] * self.size
+            self.next = 0
+
+        i = self.next
+        self.next = (i + 1) % self.size
+        if self.events[i] is not None:
+            self.events[i].synchronize()
+
+        return i, self.buffers[i]
+
+    def release(self, i, event):
+        self.events[i] = event
+
+
+class OverlappedInference:
+    # Inference of a stream of images in three stages, meant to run in separate threads
+    # (streaming.run_pipeline), each one on its own CUDA stream:
+    # - upload: test pipeline on CPU, copy into a pinned buffer, asynchronous host -> device copy,
+    # - compute: waits for the upload, preprocessing, forward pass and uint8 mask on the device,
+    # - download: waits for the compute, asynchronous device -> host copy into pinned memory.
+    # Upload of frame N+1 and download of mask N-1 thus overlap the compute of frame N.
+    # On CPU the same stages run with NullStreams.
+
+    def __init__(self, model, pipeline, slots=4):
+        self.model = model
+        self.pipeline = pipeline
+        self.device = model.data_preprocessor.device
+        self.streams = for_device(self.device)
+        self.upload_stream = self.streams.stream()
+        self.compute_stream = self.streams.stream()
+        self.download_stream = self.streams.stream()
+        self.align_corners = getattr(model, "align_corners", False)
+        self.threshold = postprocess._threshold(model)
+        self._inputs = _HostRing(self.streams, slots)
+        self._mask_host = None
+
+    def upload(self, image):
+        sample = self.pipeline(dict(img=image))
+        inputs = sample["inputs"]
+        if self.streams.host_buffers:
+            i, host = self._inputs.acquire(tuple(inputs.shape), inputs.dtype)
+            host.copy_(inputs)
+        else:
+            host = inputs
+
+        with self.streams.use(self.upload_stream):
+            device_inputs = host.to(self.device, non_blocking=True)
+            event = self.streams.record(self.upload_stream)
+
+        if self.streams.host_buffers:
+            self._inputs.release(i, event)
+
+        self.streams.keep(device_inputs, self.compute_stream)
+        return device_inputs, sample["data_samples"], event
+
+    def compute(self, uploaded):
+        inputs, data_sample, event = uploaded
+        with self.streams.use(self.compute_stream), torch.no_grad():
+            self.streams.wait(self.compute_stream, event)
+            data = self.model.data_preprocessor({"inputs": [inputs], "data_samples": [data_sample]}, False)
+            meta = data["data_samples"][0].metainfo
+            logits = self.model.inference(data["inputs"], [meta])
+            mask = torch.empty(postprocess.output_shape(meta["ori_shape"]), dtype=torch.uint8, device=self.device)
+            postprocess.mask_from_logits(logits, meta, self.align_corners, self.threshold, out=mask)
+            event = self.streams.record(self.compute_stream)
+
+        self.streams.keep(mask, self.download_stream)
+        return mask, event
+
+    def download(self, computed):
+        mask, event = computed
+        if not self.streams.host_buffers:
+            return mask.numpy()
+
+        with self.streams.use(self.download_stream):
+            self.streams.wait(self.download_stream, event)
+            if self._mask_host is None or self._mask_host.shape != mask.shape:
+                self._mask_host = self.streams.empty(mask.shape, mask.dtype)
+
+            self._mask_host.copy_(mask, non_blocking=True)
+            self.streams.record(self.download_stream).synchronize()
+
+        # Only this thread waits for the copy, the pinned buffer is reused for the next mask
+        return self._mask_host.numpy().copy()
+
+    def stages(self):
+        return [self.upload, self.compute, self.download]
+
+    def infer(self, image):
+        return self.download(self.compute(self.upload(image)))
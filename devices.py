@@ -0,0 +1,128 @@
+# Copyright (C) 2021 Ikomia SAS
+# Contact: https://www.ikomia.com
+#
+# This file is part of the IkomiaStudio software.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import sys
+
+
+def cuda_available():
+    # Default of the cuda parameter without importing torch (seconds) when it is not loaded yet:
+    # presence of the NVIDIA driver. The device is checked with torch when the model is loaded.
+    if "torch" in sys.modules:
+        return sys.modules["torch"].cuda.is_available()
+
+    if os.environ.get("CUDA_VISIBLE_DEVICES", None) in ("", "-1"):
+        return False
+
+    if sys.platform.startswith("linux"):
+        return os.path.exists("/proc/driver/nvidia/version")
+    elif sys.platform == "win32":
+        system_root = os.environ.get("SystemRoot", r"C:\Windows")
+        return os.path.isfile(os.path.join(system_root, "System32", "nvcuda.dll"))
+
+    return False
+
+
+def parse_cpus(cpulist):
+    # "0-3,8,10-11" -> [0, 1, 2, 3, 8, 10, 11]
+    cpus = []
+    for part in cpulist.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+
+    return cpus
+
+
+def numa_nodes():
+    # NUMA node -> list of its CPUs (Linux), empty elsewhere
+    nodes = {}
+    node_folder = "/sys/devices/system/node"
+    if not os.path.isdir(node_folder):
+        return nodes
+
+    for name in os.listdir(node_folder):
+        if name.startswith("node") and name[4:].isdigit():
+            with open(os.path.join(node_folder, name, "cpulist"), "r") as f:
+                cpus = parse_cpus(f.read())
+            if cpus:
+                nodes[int(name[4:])] = cpus
+
+    return dict(sorted(nodes.items()))
+
+
+def parse_devices(spec):
+    # Comma separated devices -> list of (device, cpus) replicas:
+    # - "cuda:0", "cpu": model in the current process on this device (cpus None),
+    # - "cpu:0-15": worker process pinned to these cores,
+    # - "numa:1": worker process pinned to the cores of this NUMA node,
+    # - "auto": every CUDA device, else one worker process per NUMA node, else "cpu".
+    # Core sets use ";" between cores to stay separable from devices: "cpu:0-7;16-23".
+    replicas = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+
+        if item == "auto":
+            import torch
+
+            if torch.cuda.is_available():
+                replicas.extend((f"cuda:{i}", None) for i in range(torch.cuda.device_count()))
+            elif len(numa_nodes()) > 1:
+                replicas.extend(("cpu", cpus) for cpus in numa_nodes().values())
+            else:
+                replicas.append(("cpu", None))
+        elif item.startswith("numa:"):
+            node = int(item[5:])
+            nodes = numa_nodes()
+            if node not in nodes:
+                raise Exception(f"Unknown NUMA node {node}. Available nodes are {list(nodes)}")
+            replicas.append(("cpu", nodes[node]))
+        elif item.startswith("cpu:"):
+            replicas.append(("cpu", parse_cpus(item[4:].replace(";", ","))))
+        elif item == "cpu" or item.startswith("cuda"):
+            replicas.append((item, None))
+        else:
+            raise Exception(f"Invalid device {item}: expected cuda:N, cpu, cpu:<cores>, numa:N or auto")
+
+    return replicas
+
+
+def available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def split_cpus(num_workers):
+    # Cores of the current process in num_workers contiguous sets -> list of ("cpu", cpus) replicas
+    cpus = available_cpus()
+    if num_workers > len(cpus):
+        raise Exception(f"Cannot run {num_workers} worker processes on {len(cpus)} cores")
+
+    size, extra = divmod(len(cpus), num_workers)
+    replicas = []
+    start = 0
+    for i in range(num_workers):
+        end = start + size + (1 if i < extra else 0)
+        replicas.append(("cpu", cpus[start:end]))
+        start = end
+
+    return replicas
@@ -0,0 +1,79 @@
+# Copyright (C) 2021 Ikomia SAS
+# Contact: https://www.ikomia.com
+#
+# This file is part of the IkomiaStudio software.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import copy
+import threading
+
+# Inference resolutions (factors of the config Resize scale) the adaptive policy chooses from
+LEVELS = [1.0, 0.875, 0.75, 0.625, 0.5]
+
+
+def scale_pipeline_cfg(pipeline_cfg, resolution):
+    # Test pipeline config resizing to `resolution` times the config scale.
+    # Masks are still returned at the original image size.
+    pipeline_cfg = copy.deepcopy(pipeline_cfg)
+    if resolution == 1.0:
+        return pipeline_cfg
+
+    for t in pipeline_cfg:
+        if t.get("type") == "Resize":
+            if t.get("scale") is not None:
+                scale = t["scale"]
+                scale = (scale, scale) if isinstance(scale, int) else scale
+                t["scale"] = tuple(max(1, int(s * resolution + 0.5)) for s in scale)
+            else:
+                factor = t.get("scale_factor", 1.0)
+                factor = factor if isinstance(factor, (list, tuple)) else (factor, factor)
+                t["scale_factor"] = tuple(f * resolution for f in factor)
+            return pipeline_cfg
+
+    # Images processed at their own size: resize them relatively
+    pipeline_cfg.insert(1, dict(type="Resize", scale_factor=resolution, keep_ratio=True))
+    return pipeline_cfg
+
+
+class ResolutionPolicy:
+    # Largest resolution level expected to meet a latency target. Latency is modelled as
+    # proportional to the resized image area: cost = latency / resolution², averaged over the
+    # last calls. Measured latencies include the contention of concurrent calls, so the
+    # resolution goes down under load and back up once latencies drop.
+
+    def __init__(self, target_ms, levels=None, smoothing=0.2):
+        self.target = target_ms / 1000
+        self.levels = sorted(levels or LEVELS, reverse=True)
+        self.smoothing = smoothing
+        self.cost = None
+        self._lock = threading.Lock()
+
+    def choose(self):
+        with self._lock:
+            if self.cost is None:
+                return self.levels[0]
+
+            for level in self.levels:
+                if self.cost * level ** 2 <= self.target:
+                    return level
+
+            return self.levels[-1]
+
+    def update(self, resolution, elapsed):
+        cost = elapsed / resolution ** 2
+        with self._lock:
+            if self.cost is None:
+                self.cost = cost
+            else:
+                self.cost += self.smoothing * (cost - self.cost)
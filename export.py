@@ -0,0 +1,254 @@
+# Copyright (C) 2021 Ikomia SAS
+# Contact: https://www.ikomia.com
+#
+# This file is part of the IkomiaStudio software.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import contextlib
+import inspect
+import json
+import os
+import threading
+import warnings
+
+import torch
+import torch.nn.functional as F
+
+from infer_mmlab_segmentation import postprocess
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: no inter-process lock, exported files stay atomic
+    fcntl = None
+
+ONNX_OPSET = 17
+META_FILE = "meta.json"
+LOCK_FILE = "export.lock"
+# Input (H, W) of the forward pass checking that a model gives per-class logits, when the
+# data preprocessor does not pad to a fixed size
+PROBE_SHAPE = (512, 512)
+
+# torch 2.3 (requirements) has neither the dynamo nor the external_data arguments, later
+# versions default to the dynamo exporter: the TorchScript exporter is then asked explicitly
+_EXPORT_ARGS = inspect.signature(torch.onnx.export).parameters
+
+
+class LogitsModel(torch.nn.Module):
+    # Whole-image EncoderDecoder inference: normalized padded batch -> padded logits,
+    # same as EncoderDecoder.inference() in "whole" mode
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, inputs):
+        logits = self.model.decode_head(self.model.extract_feat(inputs))
+        return F.interpolate(logits, size=inputs.shape[2:], mode="bilinear",
+                             align_corners=self.model.decode_head.align_corners)
+
+
+def check_exportable(model, pipeline):
+    from infer_mmlab_segmentation import buffers
+
+    if type(model).__name__ != "EncoderDecoder" or isinstance(model.decode_head, torch.nn.ModuleList):
+        raise Exception(f"Only EncoderDecoder models can be exported, not {type(model).__name__}")
+
+    if model.test_cfg.get("mode", "whole") != "whole":
+        raise Exception("Only models with a whole image test_cfg mode can be exported")
+
+    if not buffers.is_supported_pipeline(pipeline):
+        raise Exception("Only test pipelines made of LoadImage, Resize (cv2 bilinear) and PackSegInputs "
+                        "can be exported")
+
+    # Heads with their own predict() (e.g. MaskFormer: class and mask queries) do not give
+    # logits from forward(): what the exported graph computes
+    test_cfg = getattr(model.data_preprocessor, "test_cfg", None)
+    shape = tuple(test_cfg["size"]) if test_cfg and test_cfg.get("size") else PROBE_SHAPE
+    dummy = torch.zeros((1, 3, *shape), dtype=torch.float32, device=model.data_preprocessor.device)
+    try:
+        with torch.no_grad():
+            logits = model.decode_head(model.extract_feat(dummy))
+    except Exception as e:
+        raise Exception(f"{type(model.decode_head).__name__} cannot be exported, forward pass failed: {e}")
+
+    num_classes = len(model.dataset_meta["classes"])
+    if not torch.is_tensor(logits) or logits.dim() != 4 or logits.shape[1] not in (1, num_classes):
+        raise Exception(f"{type(model.decode_head).__name__} cannot be exported: its forward pass does not "
+                        f"give per-class logits, use the pytorch backend")
+
+
+def preprocessing_meta(model, pipeline):
+    # Everything needed to reproduce the test pipeline and SegDataPreProcessor without mmseg
+    resize = None
+    for t in pipeline.transforms:
+        if type(t).__name__ == "Resize":
+            scale_factor = t.scale_factor
+            resize = {
+                "scale": list(t.scale) if t.scale is not None else None,
+                "scale_factor": list(scale_factor) if isinstance(scale_factor, tuple) else scale_factor,
+                "keep_ratio": t.keep_ratio,
+            }
+
+    preprocessor = model.data_preprocessor
+    normalize = getattr(preprocessor, "_enable_normalize", False)
+    test_cfg = getattr(preprocessor, "test_cfg", None)
+    return {
+        "classes": list(model.dataset_meta["classes"]),
+        "resize": resize,
+        "channel_conversion": bool(getattr(preprocessor, "channel_conversion", False)),
+        "mean": preprocessor.mean.flatten().tolist() if normalize else None,
+        "std": preprocessor.std.flatten().tolist() if normalize else None,
+        "pad_val": float(getattr(preprocessor, "pad_val", 0)),
+        "pad_size": list(test_cfg["size"]) if test_cfg and test_cfg.get("size") else None,
+        "pad_size_divisor": test_cfg.get("size_divisor") if test_cfg else None,
+        "align_corners": bool(model.decode_head.align_corners),
+        "threshold": postprocess._threshold(model),
+        # Unknown until the first export
+        "dynamic": None,
+    }
+
+
+def export_onnx(model, onnx_file, shape, dynamic=True):
+    # Export at the given (H, W). With dynamic=True height and width are dynamic axes, unless
+    # tracing reports shape-dependent Python values (adaptive pooling output sizes, shape
+    # comparisons...): such a graph would only be valid at the traced shape, so the export
+    # falls back to a static spatial shape. The batch axis is always dynamic.
+    # Returns True if the exported graph accepts any input shape.
+    wrapper = LogitsModel(model).eval()
+    device = model.data_preprocessor.device
+    dummy = torch.zeros((1, 3, *shape), dtype=torch.float32, device=device)
+    tmp_file = f"{onnx_file}.{os.getpid()}.tmp"
+
+    def _export(axes):
+        options = {"dynamo": False} if "dynamo" in _EXPORT_ARGS else {}
+        with warnings.catch_warnings(record=True) as caught, torch.no_grad():
+            warnings.simplefilter("always", torch.jit.TracerWarning)
+            torch.onnx.export(wrapper, (dummy,), tmp_file, opset_version=ONNX_OPSET,
+                              input_names=["inputs"], output_names=["logits"],
+                              dynamic_axes={"inputs": axes, "logits": axes}, **options)
+        return not any(issubclass(w.category, torch.jit.TracerWarning) for w in caught)
+
+    def _export_dynamo():
+        # The TorchScript exporter rejects some operators, e.g. adaptive pooling to output
+        # sizes that do not divide the input size (PSPNet), the dynamo exporter decomposes them
+        with torch.no_grad():
+            if "dynamo" in _EXPORT_ARGS:
+                options = {"external_data": False} if "external_data" in _EXPORT_ARGS else {}
+                torch.onnx.export(wrapper, (dummy,), tmp_file, dynamo=True, verbose=False,
+                                  input_names=["inputs"], output_names=["logits"],
+                                  dynamic_shapes=({0: torch.export.Dim("batch")},), **options)
+            else:
+                # torch < 2.5: separate entry point, input names given by the traced graph
+                options = torch.onnx.ExportOptions(dynamic_shapes=True)
+                torch.onnx.dynamo_export(wrapper, dummy, export_options=options).save(tmp_file)
+
+    is_dynamic = False
+    if dynamic:
+        try:
+            is_dynamic = _export({0: "batch", 2: "height", 3: "width"})
+        except Exception:
+            is_dynamic = False
+
+    if not is_dynamic:
+        try:
+            _export({0: "batch"})
+        except Exception:
+            _export_dynamo()
+
+    os.replace(tmp_file, onnx_file)
+    return is_dynamic
+
+
+class Exporter:
+    # Exports the graphs of one (config, checkpoint) couple into its cache folder.
+    # The PyTorch model, and thus mmseg, is only loaded when something has to be exported.
+
+    def __init__(self, cfg_file, ckpt_file, folder):
+        self.cfg_file = cfg_file
+        self.ckpt_file = ckpt_file
+        self.folder = folder
+        self.model = None
+        self.pipeline = None
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # Threads of this process, then other processes exporting to the same folder
+        with self._lock:
+            os.makedirs(self.folder, exist_ok=True)
+            with open(os.path.join(self.folder, LOCK_FILE), "a") as lock:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _load(self):
+        if self.model is None:
+            from infer_mmlab_segmentation import inference
+
+            self.model = inference.init_segmentor(self.cfg_file, self.ckpt_file, "cpu")
+            self.pipeline = inference.build_test_pipeline(self.model)
+            check_exportable(self.model, self.pipeline)
+
+        return self.model
+
+    def _write_meta(self, meta):
+        tmp_file = os.path.join(self.folder, f"{META_FILE}.{os.getpid()}.tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(meta, f, indent=2)
+        os.replace(tmp_file, os.path.join(self.folder, META_FILE))
+
+    def meta(self):
+        meta_file = os.path.join(self.folder, META_FILE)
+        with self._locked():
+            if not os.path.isfile(meta_file):
+                self._load()
+                self._write_meta(preprocessing_meta(self.model, self.pipeline))
+
+            with open(meta_file, "r") as f:
+                return json.load(f)
+
+    def _graph_path(self, dynamic, shape):
+        return os.path.join(self.folder, "model.onnx" if dynamic else f"model_{shape[0]}x{shape[1]}.onnx")
+
+    def graph_file(self, shape):
+        # ONNX graph accepting inputs of the given (H, W), exported on first request.
+        # Concurrent callers, in this process or others, wait for the first export.
+        with self._locked():
+            meta_file = os.path.join(self.folder, META_FILE)
+            with open(meta_file, "r") as f:
+                meta = json.load(f)
+
+            if meta["dynamic"] is not None:
+                onnx_file = self._graph_path(meta["dynamic"], shape)
+                if not os.path.isfile(onnx_file):
+                    export_onnx(self._load(), onnx_file, shape, dynamic=False)
+                return onnx_file
+
+            # First export: try dynamic spatial axes, the result decides the layout of the cache
+            probe_file = os.path.join(self.folder, f"probe.{os.getpid()}.onnx")
+            is_dynamic = export_onnx(self._load(), probe_file, shape, dynamic=True)
+            onnx_file = self._graph_path(is_dynamic, shape)
+            os.replace(probe_file, onnx_file)
+            meta["dynamic"] = is_dynamic
+            self._write_meta(meta)
+            return onnx_file
+
+    def release(self):
+        # The PyTorch model is not needed anymore once the graphs are exported
+        self.model = None
+        self.pipeline = None
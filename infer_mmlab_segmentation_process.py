@@ -15,17 +15,19 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import contextlib
 import copy
+import logging
 import os
-import yaml
-
-import torch
-from torch.cuda import is_available
+import time
 
 from ikomia import core, dataprocess, utils
 
-from mmseg.apis import init_model, inference_model
-from mmseg.utils import register_all_modules
+# Import-light modules only: torch, mmseg and the modules depending on them are imported
+# on first use, so that listing the model zoo or editing parameters stays fast
+from infer_mmlab_segmentation import checkpoint_store, devices, dynamic_resolution, model_cache, streaming, zoo_index
+
+logger = logging.getLogger(__name__)
 
 
 # --------------------
@@ -42,13 +44,42 @@ class InferMmlabSegmentationParam(core.CWorkflowTaskParam):
         self.model_name = "maskformer"
         self.model_config = "maskformer_r50-d32_8xb2-160k_ade20k-512x512"
         self.update = False
-        self.cuda = is_available()
+        self.cuda = devices.cuda_available()
         self.custom_cfg = ""
         self.model_path = ""
+        self.batch_size = 1
+        self.tile_size = 0
+        self.tile_overlap = 128
+        self.tile_blending = "gaussian"
+        self.mmap_weights = False
+        self.fixed_shape = False
+        self.stage_timing = False
+        self.metrics_sink = "log"
+        self.metrics_path = ""
+        self.profiler = "none"
+        self.precision = "fp32"
+        self.calibration_folder = ""
+        self.backend = "pytorch"
+        self.intra_op_threads = 0
+        self.inter_op_threads = 0
+        self.num_streams = 0
+        self.compile_mode = "none"
+        self.cpu_optimization = False
+        self.resolution = 1.0
+        self.target_latency_ms = 0.0
+        self.slide_batch_size = 4
+        self.tta = False
+        self.tta_scales = "0.5,0.75,1.0,1.25,1.5,1.75"
+        self.tta_flip = True
+        self.tta_agreement = 0.0
+        self.overlap_transfers = False
+        self.devices = ""
+        self.process_workers = 0
 
     def set_values(self, param_map):
         # Set parameters values from Ikomia application
         # Parameters values are stored as string and accessible like a python dict
+        # Workflows saved before a parameter existed keep its default value
         self.model_weight_file = param_map["model_weight_file"]
         self.config_file = param_map["config_file"]
         self.model_name = param_map["model_name"]
@@ -56,6 +87,34 @@ class InferMmlabSegmentationParam(core.CWorkflowTaskParam):
         self.cuda = utils.strtobool(param_map["cuda"])
         self.custom_cfg = param_map["custom_cfg"]
         self.model_path = param_map["model_path"]
+        self.batch_size = int(param_map.get("batch_size", str(self.batch_size)))
+        self.tile_size = int(param_map.get("tile_size", str(self.tile_size)))
+        self.tile_overlap = int(param_map.get("tile_overlap", str(self.tile_overlap)))
+        self.tile_blending = param_map.get("tile_blending", self.tile_blending)
+        self.mmap_weights = utils.strtobool(param_map.get("mmap_weights", str(self.mmap_weights)))
+        self.fixed_shape = utils.strtobool(param_map.get("fixed_shape", str(self.fixed_shape)))
+        self.stage_timing = utils.strtobool(param_map.get("stage_timing", str(self.stage_timing)))
+        self.metrics_sink = param_map.get("metrics_sink", self.metrics_sink)
+        self.metrics_path = param_map.get("metrics_path", self.metrics_path)
+        self.profiler = param_map.get("profiler", self.profiler)
+        self.precision = param_map.get("precision", self.precision)
+        self.calibration_folder = param_map.get("calibration_folder", self.calibration_folder)
+        self.backend = param_map.get("backend", self.backend)
+        self.intra_op_threads = int(param_map.get("intra_op_threads", str(self.intra_op_threads)))
+        self.inter_op_threads = int(param_map.get("inter_op_threads", str(self.inter_op_threads)))
+        self.num_streams = int(param_map.get("num_streams", str(self.num_streams)))
+        self.compile_mode = param_map.get("compile_mode", self.compile_mode)
+        self.cpu_optimization = utils.strtobool(param_map.get("cpu_optimization", str(self.cpu_optimization)))
+        self.resolution = float(param_map.get("resolution", str(self.resolution)))
+        self.target_latency_ms = float(param_map.get("target_latency_ms", str(self.target_latency_ms)))
+        self.slide_batch_size = int(param_map.get("slide_batch_size", str(self.slide_batch_size)))
+        self.tta = utils.strtobool(param_map.get("tta", str(self.tta)))
+        self.tta_scales = param_map.get("tta_scales", self.tta_scales)
+        self.tta_flip = utils.strtobool(param_map.get("tta_flip", str(self.tta_flip)))
+        self.tta_agreement = float(param_map.get("tta_agreement", str(self.tta_agreement)))
+        self.overlap_transfers = utils.strtobool(param_map.get("overlap_transfers", str(self.overlap_transfers)))
+        self.devices = param_map.get("devices", self.devices)
+        self.process_workers = int(param_map.get("process_workers", str(self.process_workers)))
 
     def get_values(self):
         # Send parameters values to Ikomia application
@@ -68,6 +127,34 @@ class InferMmlabSegmentationParam(core.CWorkflowTaskParam):
                 "cuda": str(self.cuda),
                 "custom_cfg": self.custom_cfg,
                 "model_path": self.model_path,
+                "batch_size": str(self.batch_size),
+                "tile_size": str(self.tile_size),
+                "tile_overlap": str(self.tile_overlap),
+                "tile_blending": self.tile_blending,
+                "mmap_weights": str(self.mmap_weights),
+                "fixed_shape": str(self.fixed_shape),
+                "stage_timing": str(self.stage_timing),
+                "metrics_sink": self.metrics_sink,
+                "metrics_path": self.metrics_path,
+                "profiler": self.profiler,
+                "precision": self.precision,
+                "calibration_folder": self.calibration_folder,
+                "backend": self.backend,
+                "intra_op_threads": str(self.intra_op_threads),
+                "inter_op_threads": str(self.inter_op_threads),
+                "num_streams": str(self.num_streams),
+                "compile_mode": self.compile_mode,
+                "cpu_optimization": str(self.cpu_optimization),
+                "resolution": str(self.resolution),
+                "target_latency_ms": str(self.target_latency_ms),
+                "slide_batch_size": str(self.slide_batch_size),
+                "tta": str(self.tta),
+                "tta_scales": self.tta_scales,
+                "tta_flip": str(self.tta_flip),
+                "tta_agreement": str(self.tta_agreement),
+                "overlap_transfers": str(self.overlap_transfers),
+                "devices": self.devices,
+                "process_workers": str(self.process_workers),
                 }
         return param_map
 
@@ -81,9 +168,18 @@ class InferMmlabSegmentation(dataprocess.CSemanticSegmentationTask):
     def __init__(self, name, param):
         dataprocess.CSemanticSegmentationTask.__init__(self, name)
         # Add input/output of the process here
-        register_all_modules()
         self.model = None
+        self.model_key = None
+        self.backend = None
+        self.pipeline = None
+        self.pipelines = {}
+        self.resolution_policy = None
+        self.fixed_buffers = None
         self.classes = None
+        self.metrics_sinks = []
+        self.stage_timings = {}
+        self._param_sink = None
+        self._param_sink_key = None
 
         # Create parameters class
         if param is None:
@@ -91,6 +187,11 @@ class InferMmlabSegmentation(dataprocess.CSemanticSegmentationTask):
         else:
             self.set_param_object(copy.deepcopy(param))
 
+    def __del__(self):
+        # Give the shared model back to the process-wide cache, stop device pool workers
+        if getattr(self, "model", None) is not None:
+            self._release_model()
+
     def get_progress_steps(self, eltCount=1):
         # Function returning the number of progress steps for this process
         # This is handled by the main progress bar of Ikomia application
@@ -99,29 +200,10 @@ class InferMmlabSegmentation(dataprocess.CSemanticSegmentationTask):
     @staticmethod
     def get_absolute_paths(param):
         if param.model_weight_file == "":
-            yaml_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "configs", param.model_name,
-                                     "metafile.yaml")
-
             if param.model_config.endswith('.py'):
                 param.model_config = param.model_config[:-3]
-            if os.path.isfile(yaml_file):
-                with open(yaml_file, "r") as f:
-                    models_list = yaml.load(f, Loader=yaml.FullLoader)['Models']
-
-                available_cfg_ckpt = {model_dict["Name"]: {'cfg': model_dict["Config"],
-                                                           'ckpt': model_dict["Weights"]}
-                                      for model_dict in models_list}
-
-                if param.model_config in available_cfg_ckpt:
-                    cfg_file = available_cfg_ckpt[param.model_config]['cfg']
-                    ckpt_file = available_cfg_ckpt[param.model_config]['ckpt']
-                    cfg_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), cfg_file)
-                    return cfg_file, ckpt_file
-                else:
-                    raise Exception(
-                        f"{param.model_config} does not exist for {param.model_name}. Available configs for are {', '.join(list(available_cfg_ckpt.keys()))}")
-            else:
-                raise Exception(f"Model name {param.model_name} does not exist.")
+
+            return zoo_index.get_paths(param.model_name, param.model_config)
         else:
             if os.path.isfile(param.model_config):
                 cfg_file = param.model_config
@@ -133,45 +215,122 @@ class InferMmlabSegmentation(dataprocess.CSemanticSegmentationTask):
 
     @staticmethod
     def get_model_zoo():
-        configs_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "configs")
         available_pairs = []
+        for model_name, configs in zoo_index.get_index()["models"].items():
+            for model_config in configs:
+                available_pairs.append({
+                    "model_name": model_name,
+                    "model_config": model_config
+                })
 
-        for model_name in os.listdir(configs_folder):
-            if model_name.startswith('_'):
-                continue
-
-            yaml_file = os.path.join(configs_folder, model_name, "metafile.yaml")
-            if os.path.isfile(yaml_file):
-                with open(yaml_file, "r") as f:
-                    models_list = yaml.load(f, Loader=yaml.FullLoader)
-                    if 'Models' in models_list:
-                        models_list = models_list['Models']
-
-                    if not isinstance(models_list, list):
-                        continue
+        return available_pairs
 
-                for model_dict in models_list:
-                    available_pairs.append({
-                        "model_name": model_name,
-                        "model_config": os.path.basename(model_dict["Name"])
-                    })
+    def _release_model(self):
+        if self.model_key is not None:
+            model_cache.get_registry().release(self.model_key)
+        elif self.backend == "device_pool" and self.model is not None:
+            self.model.close()
 
-        return available_pairs
+        self.model = None
+        self.model_key = None
 
     def _load_model(self):
+        import torch
+        from infer_mmlab_segmentation import backends, buffers, compilation, cpu_optimization, device_pool, \
+            devices, inference, quantization, sliding
+
         param = self.get_param_object()
         # Set cache dir in the algorithm folder to simplify deployment
         old_torch_hub = torch.hub.get_dir()
         torch.hub.set_dir(os.path.join(os.path.dirname(__file__), "models"))
 
-        cuda_available = is_available()
+        cuda_available = torch.cuda.is_available()
         cfg_file, ckpt_file = self.get_absolute_paths(param)
-
-        self.model = init_model(cfg_file, ckpt_file, device='cuda:0' if param.cuda and cuda_available else 'cpu')
-
-        # trick to avoid KeyError "seg_map_path" when loading annotations
-        self.model.cfg.test_pipeline = [t for t in self.model.cfg.test_pipeline if "reduce_zero_label" not in t]
-        self.classes = self.model.dataset_meta["classes"]
+        device = 'cuda:0' if param.cuda and cuda_available else 'cpu'
+        precision = param.precision
+        if precision != "fp32":
+            # INT8 kernels are CPU only
+            device = 'cpu'
+            if precision == "int8_static":
+                precision = f"{precision}:{os.path.abspath(param.calibration_folder)}"
+
+        # BatchNorm folding and channels_last: CPU inference only
+        optimize = param.cpu_optimization and device == 'cpu'
+
+        def load():
+            model = inference.init_segmentor(cfg_file, ckpt_file, device, param.mmap_weights)
+            pipeline = inference.build_test_pipeline(model)
+            if optimize:
+                model = cpu_optimization.optimize(model, pipeline)
+
+            local_ckpt_file = checkpoint_store.resolve(ckpt_file)
+            model = quantization.quantize(model, param.precision,
+                                          pipeline=pipeline,
+                                          ckpt_file=local_ckpt_file,
+                                          calibration_folder=param.calibration_folder)
+            model = compilation.apply(model, pipeline, param.compile_mode,
+                                      compilation.cache_folder(cfg_file, local_ckpt_file, device, model,
+                                                               param.precision, optimize))
+            return sliding.apply(model, param.slide_batch_size)
+
+        # Identical models are loaded once per process and shared between task instances
+        self._release_model()
+        backend = param.backend
+        if param.devices or param.process_workers > 0:
+            # Model replicated over several devices or pinned worker processes, not shared between tasks
+            if param.backend != "pytorch":
+                raise Exception("Device pools are only available with the pytorch backend")
+            if param.devices and param.process_workers > 0:
+                raise Exception("Set either devices or process_workers, not both")
+            # Replicas only run infer_batch()
+            if param.tile_size > 0 or param.tta:
+                raise Exception("Tiled inference and test-time augmentation are not available with devices "
+                                "or process_workers")
+            ignored = [name for name, default in (("precision", "fp32"), ("compile_mode", "none"),
+                                                  ("cpu_optimization", False)) if getattr(param, name) != default]
+            if ignored:
+                logger.warning(f"{', '.join(ignored)} ignored by device pools: replicas run the FP32 eager model")
+
+            if param.devices:
+                replica_specs = devices.parse_devices(param.devices)
+            else:
+                replica_specs = devices.split_cpus(param.process_workers)
+            # Worker processes map the same weights file: one copy in the page cache for all of them
+            mmap_weights = param.mmap_weights or param.process_workers > 0
+            loader = device_pool.make_loader(cfg_file, checkpoint_store.resolve(ckpt_file), mmap_weights,
+                                             param.slide_batch_size)
+            replicas = device_pool.make_replicas(replica_specs, loader, param.intra_op_threads)
+            model_key = None
+            backend = "device_pool"
+            self.model = device_pool.DevicePool(replicas, param.batch_size)
+            self.pipeline = None
+            self.fixed_buffers = None
+            self.classes = self.model.classes
+        elif param.backend == "pytorch":
+            model_key = model_cache.make_key(cfg_file, ckpt_file, device, precision, compile_mode=param.compile_mode,
+                                             cpu_optimization=optimize, slide_batch_size=param.slide_batch_size)
+            self.model = model_cache.get_registry().acquire(model_key, load)
+            self.pipeline = inference.build_test_pipeline(self.model)
+            self.fixed_buffers = buffers.FixedShapeBuffers(self.model, self.pipeline) if param.fixed_shape else None
+            self.classes = self.model.dataset_meta["classes"]
+        else:
+            # Exported graph on CPU, preprocessing and postprocessing without mmseg
+            if param.backend == "openvino":
+                options = {"intra_op_threads": param.intra_op_threads, "num_streams": param.num_streams}
+            else:
+                options = {"intra_op_threads": param.intra_op_threads, "inter_op_threads": param.inter_op_threads}
+            model_key = model_cache.make_key(cfg_file, ckpt_file, 'cpu', backend=param.backend, **options)
+            self.model = model_cache.get_registry().acquire(
+                model_key, lambda: backends.load(param.backend, cfg_file, ckpt_file, **options))
+            self.pipeline = None
+            self.fixed_buffers = None
+            self.classes = self.model.classes
+
+        self.model_key = model_key
+        self.backend = backend
+        self.pipelines = {1.0: self.pipeline}
+        self.resolution_policy = dynamic_resolution.ResolutionPolicy(param.target_latency_ms) \
+            if param.target_latency_ms > 0 else None
         self.set_names(list(self.classes))
 
         param.update = False
@@ -179,29 +338,229 @@ class InferMmlabSegmentation(dataprocess.CSemanticSegmentationTask):
         # Reset torch cache dir for next algorithms in the workflow
         torch.hub.set_dir(old_torch_hub)
 
+    def evaluate_precision(self, validation_folder, max_images=None):
+        # Accuracy of the current model (quantized, or exported with the onnxruntime / openvino
+        # backends) against the FP32 PyTorch model on a validation set.
+        # validation_folder: images, or "images" and "labels" sub-folders for mIoU vs ground truth.
+        from infer_mmlab_segmentation import inference, quantization
+
+        param = self.get_param_object()
+        if self.model is None or param.update:
+            self._load_model()
+
+        cfg_file, ckpt_file = self.get_absolute_paths(param)
+        reference = inference.init_segmentor(cfg_file, ckpt_file, 'cpu', param.mmap_weights)
+        # Same test resolution for both models
+        report = quantization.evaluate(reference, lambda images: self.infer_batch(images, resolution=1.0),
+                                       validation_folder, max_images)
+        report["precision"] = param.precision
+        report["backend"] = self.backend
+        return report
+
+    def add_metrics_sink(self, sink):
+        # Any object with an emit(record) method, called after each run when stage_timing is enabled
+        self.metrics_sinks.append(sink)
+
+    def get_stage_timings(self):
+        # Seconds per stage of the last run (stage_timing parameter)
+        return dict(self.stage_timings)
+
+    def _emit_timings(self, timer):
+        from infer_mmlab_segmentation import profiling
+
+        param = self.get_param_object()
+        self.stage_timings = dict(timer.timings)
+        record = {
+            "model": f"{param.model_name}/{param.model_config}",
+            "timestamp": time.time(),
+            "stages": self.stage_timings,
+        }
+        # Sink selected by parameters, recreated when they change
+        sink_key = (param.metrics_sink, param.metrics_path)
+        if sink_key != self._param_sink_key:
+            self._param_sink = profiling.make_sink(param.metrics_sink, param.metrics_path)
+            self._param_sink_key = sink_key
+
+        for sink in [self._param_sink] + self.metrics_sinks:
+            sink.emit(record)
+
     def init_long_process(self):
         self._load_model()
         super().init_long_process()
 
+    def _pipeline(self, resolution):
+        from infer_mmlab_segmentation import inference
+
+        pipeline = self.pipelines.get(resolution)
+        if pipeline is None:
+            pipeline = self.pipelines[resolution] = inference.build_test_pipeline(self.model, resolution)
+
+        return pipeline
+
+    def infer_batch(self, images, scale=1.0, roi=None, timer=None, resolution=None):
+        # Programmatic entry point: list of numpy images -> list of uint8 masks.
+        # scale < 1 returns downsampled masks, roi=(x, y, w, h) only the given region.
+        # resolution: factor of the config Resize scale for this call (default: resolution
+        # parameter, or chosen by the adaptive policy when target_latency_ms is set).
+        # Masks always have the size of the original images.
+        from infer_mmlab_segmentation import inference
+
+        param = self.get_param_object()
+        if self.model is None or param.update:
+            self._load_model()
+
+        policy = self.resolution_policy
+        if resolution is None:
+            resolution = policy.choose() if policy is not None else param.resolution
+
+        t0 = time.perf_counter()
+        if self.backend != "pytorch":
+            masks = self.model.infer_batch(images, param.batch_size, scale, roi, timer, resolution)
+        else:
+            masks = inference.infer_batch(self.model, self._pipeline(resolution), images, param.batch_size, scale,
+                                          roi, timer)
+
+        if policy is not None and images:
+            policy.update(resolution, (time.perf_counter() - t0) / len(images))
+
+        return masks
+
+    def infer_tta(self, image, scale=1.0, roi=None, timer=None):
+        # Test-time augmentation: probabilities averaged over the tta_scales resolutions and
+        # their horizontal flips (tta_flip), -> uint8 mask of the original image size
+        from infer_mmlab_segmentation import tta
+
+        param = self.get_param_object()
+        if self.model is None or param.update:
+            self._load_model()
+
+        if self.backend != "pytorch":
+            raise Exception("Test-time augmentation is only available with the pytorch backend")
+
+        augmentation = tta.TestTimeAugmentation(self.model, self._pipeline, param.tta_scales, param.tta_flip,
+                                                param.tta_agreement)
+        return augmentation.infer(image, scale, roi, timer)
+
+    def infer_tiled(self, image, out=None):
+        # Large image inference tile by tile. out: optional preallocated uint8 mask
+        # or path of a .npy file to write the mask to as a memory-mapped array.
+        from infer_mmlab_segmentation import tiling
+
+        param = self.get_param_object()
+        tile_size = param.tile_size if param.tile_size > 0 else 1024
+        tiling.check_tiling(tile_size, param.tile_overlap)
+        if self.model is None or param.update:
+            self._load_model()
+
+        if self.backend != "pytorch":
+            raise Exception("Tiled inference is only available with the pytorch backend")
+
+        return tiling.infer_tiled(self.model, self.pipeline, image,
+                                  tile_size=tile_size,
+                                  overlap=param.tile_overlap,
+                                  blending=param.tile_blending,
+                                  batch_size=param.batch_size,
+                                  out=out)
+
+    def infer_stream(self, frames, queue_size=2):
+        # Generator: iterable of numpy frames -> uint8 masks in the same order.
+        # Decoding, preprocessing, forward pass and mask extraction run in
+        # separate threads so that they overlap from one frame to the next.
+        from infer_mmlab_segmentation import buffers, device_streams, inference, postprocess
+
+        param = self.get_param_object()
+        if self.model is None or param.update:
+            self._load_model()
+
+        model = self.model
+        if self.backend == "device_pool":
+            # Replicas work in parallel, masks still come back in order
+            return model.map(frames)
+        elif self.backend == "openvino":
+            # Frames pipelined through the asynchronous infer queue
+            return model.map(frames)
+        elif self.backend != "pytorch":
+            stages = [
+                lambda frame: model.prepare([frame]),
+                lambda prepared: (model.forward(prepared[0]), prepared[1]),
+                lambda outputs: model.masks(*outputs)[0],
+            ]
+        elif param.overlap_transfers:
+            # Pinned buffers for every frame in flight between upload and compute
+            overlapped = device_streams.OverlappedInference(model, self.pipeline, slots=queue_size + 2)
+            stages = overlapped.stages()
+        elif param.fixed_shape:
+            # Enough slots for every frame in flight between the first and the last stage
+            fixed_buffers = buffers.FixedShapeBuffers(model, self.pipeline, slots=2 * queue_size + 3)
+            stages = [
+                fixed_buffers.prepare,
+                lambda data: (inference.predict_logits(model, data), data),
+                lambda outputs: fixed_buffers.masks(*outputs)[0],
+            ]
+        else:
+            pipeline = self.pipeline
+            stages = [
+                lambda frame: inference.prepare_batch(model, pipeline, [frame]),
+                lambda data: (inference.predict_logits(model, data), data["data_samples"]),
+                lambda outputs: postprocess.masks_from_logits(model, *outputs)[0],
+            ]
+        return streaming.run_pipeline(frames, stages, queue_size)
+
+    def async_segmenter(self, max_batch=0, max_wait_ms=5.0, executor=None):
+        # asyncio API: mask = await segmenter.infer(image), concurrent requests are batched
+        from infer_mmlab_segmentation import async_inference
+
+        return async_inference.AsyncSegmenter(self, max_batch, max_wait_ms, executor)
+
     def run(self):
         # Core function of your process
         # Call begin_task_run for initialization
+        from infer_mmlab_segmentation import profiling
+
         self.begin_task_run()
         # Get input :
         img_input = self.get_input(0)
 
         # Get parameters :
         param = self.get_param_object()
-        if param.update:
+        if param.update or self.model is None:
             self._load_model()
 
-        # Get image from input/output (numpy array):
-        src_image = img_input.get_image()
+        pytorch = self.backend == "pytorch"
+        # No nn.Parameter left in BatchNorm folded INT8 models: device of the data preprocessor
+        cuda = pytorch and self.model.data_preprocessor.device.type == "cuda"
+        timer = None
+        if param.stage_timing:
+            if pytorch:
+                profiling.install_hooks(self.model)
+            timer = profiling.StageTimer(sync=cuda, record_functions=param.profiler == "torch")
+
+        # abspath: a bare file name has no folder
+        profile_folder = os.path.dirname(os.path.abspath(param.metrics_path)) if param.metrics_path else \
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles")
+
+        with profiling.capture(param.profiler, profile_folder, param.model_name, cuda), \
+                timer.activate() if timer is not None else contextlib.nullcontext():
+            # Get image from input/output (numpy array):
+            with profiling.stage(timer, "get_image"):
+                src_image = img_input.get_image()
+
+            if src_image is not None:
+                if 0 < param.tile_size < max(src_image.shape[:2]):
+                    with profiling.stage(timer, "tiled_inference"):
+                        mask = self.infer_tiled(src_image)
+                elif param.tta:
+                    mask = self.infer_tta(src_image, timer=timer)
+                elif self.fixed_buffers is not None and param.resolution == 1.0 and self.resolution_policy is None:
+                    mask = self.fixed_buffers.infer(src_image, timer)
+                else:
+                    mask = self.infer_batch([src_image], timer=timer)[0]
+
+                with profiling.stage(timer, "set_mask"):
+                    self.set_mask(mask)
 
-        if src_image is not None:
-            result = inference_model(self.model, src_image).to_dict()
-            pred_sem_seg = result["pred_sem_seg"]["data"].detach().cpu().squeeze().numpy()
-            self.set_mask(pred_sem_seg.astype("uint8"))
+        if timer is not None:
+            self._emit_timings(timer)
 
         # Step progress bar:
         self.emit_step_progress()
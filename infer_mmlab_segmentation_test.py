@@ -1,14 +1,479 @@
 import logging
+import os
+import subprocess
+import sys
 import cv2
+import numpy as np
 from ikomia.utils.tests import run_for_test
 
 logger = logging.getLogger(__name__)
 
+# Seconds allowed to import the process module, list the model zoo and create parameters and task,
+# Ikomia API import excluded
+IMPORT_BUDGET = 1.0
+HEAVY_MODULES = ("torch", "mmseg", "mmcv", "mmengine", "cv2", "onnxruntime", "openvino")
+
+IMPORT_SCRIPT = """
+import sys, time
+from ikomia import core, dataprocess, utils
+before = set(sys.modules)
+t0 = time.perf_counter()
+from infer_mmlab_segmentation.infer_mmlab_segmentation_process import InferMmlabSegmentation, \\
+    InferMmlabSegmentationFactory, InferMmlabSegmentationParam
+InferMmlabSegmentation.get_model_zoo()
+InferMmlabSegmentationParam().get_values()
+InferMmlabSegmentationFactory().create()
+elapsed = time.perf_counter() - t0
+loaded = sorted({m.split(".")[0] for m in set(sys.modules) - before})
+print(elapsed)
+print(",".join(loaded))
+"""
+
+
+def test_import_time(budget=IMPORT_BUDGET):
+    # Fresh interpreter: modules already imported by the test runner would hide the cost
+    plugin_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([plugin_parent] + sys.path))
+    output = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], env=env, capture_output=True, text=True,
+                            check=True).stdout.splitlines()
+    elapsed, loaded = float(output[-2]), output[-1].split(",")
+    logger.info(f"Import time: {elapsed:.3f}s (budget {budget:.3f}s)")
+
+    heavy = [m for m in HEAVY_MODULES if m in loaded]
+    if heavy:
+        raise Exception(f"Modules imported before the first inference: {', '.join(heavy)}")
+    if elapsed > budget:
+        raise Exception(f"Import time {elapsed:.3f}s exceeds the {budget:.3f}s budget")
+
+
+def _stand_in_loader(device):
+    # Test double of a loaded mmseg model and its test pipeline: 4 classes from a fixed 1x1
+    # convolution, inputs padded to a multiple of 16 like SegDataPreProcessor.
+    # torch is imported here: worker processes load it once pinned to their cores.
+    import torch
+    import torch.nn.functional as F
+
+    class Sample:
+
+        def __init__(self, metainfo):
+            self.metainfo = metainfo
+
+    class Preprocessor:
+
+        def __init__(self):
+            self.device = torch.device(device)
+
+        def __call__(self, data, training=False):
+            inputs = torch.stack([x.float() for x in data["inputs"]]).to(self.device)
+            bottom, right = -inputs.shape[2] % 16, -inputs.shape[3] % 16
+            inputs = F.pad(inputs, (0, right, 0, bottom))
+            samples = [Sample(dict(s.metainfo, padding_size=[0, right, 0, bottom])) for s in data["data_samples"]]
+            return {"inputs": inputs, "data_samples": samples}
+
+    class Model(torch.nn.Module):
+
+        def __init__(self):
+            super().__init__()
+            self.conv = torch.nn.Conv2d(3, 4, 1)
+            with torch.no_grad():
+                self.conv.weight.copy_(torch.arange(12.0).reshape(4, 3, 1, 1).sin())
+                self.conv.bias.zero_()
+            self.decode_head = torch.nn.Module()
+            self.data_preprocessor = Preprocessor()
+            self.dataset_meta = {"classes": ["a", "b", "c", "d"]}
+
+        def inference(self, inputs, batch_img_metas):
+            return self.conv(inputs / 255)
+
+        def forward(self, inputs, data_samples, mode="predict"):
+            # Logits without padding, as in EncoderDecoder.postprocess_result()
+            results = []
+            for logits, sample in zip(self.inference(inputs, None), data_samples):
+                h, w = sample.metainfo["ori_shape"][:2]
+                results.append(Sample({}))
+                results[-1].seg_logits = Sample({})
+                results[-1].seg_logits.data = logits[:, :h, :w]
+            return results
+
+    def pipeline(results):
+        img = results["img"]
+        inputs = torch.from_numpy(np.ascontiguousarray(img.transpose(2, 0, 1)))
+        return {"inputs": inputs, "data_samples": Sample({"ori_shape": img.shape[:2], "img_shape": img.shape[:2]})}
+
+    return Model().eval().to(device), pipeline
+
+
+def _test_images(count, seed=0):
+    # Random images of a few sizes: a mask returned for the wrong image does not match
+    rng = np.random.default_rng(seed)
+    return [rng.integers(0, 256, (40 + 8 * (i % 3), 56 + 4 * (i % 2), 3), dtype=np.uint8) for i in range(count)]
+
+
+def _check_masks(masks, expected, name):
+    if len(masks) != len(expected):
+        raise Exception(f"{name}: {len(masks)} masks returned for {len(expected)} images")
+    for i, (mask, ref) in enumerate(zip(masks, expected)):
+        if mask.shape != ref.shape or not np.array_equal(mask, ref):
+            raise Exception(f"{name}: mask {i} differs from the reference")
+
+
+def _reference_mask(logits, meta, align_corners, threshold, size):
+    # Path of EncoderDecoder.postprocess_result(): full tensor resize then argmax
+    import torch
+    import torch.nn.functional as F
+    from infer_mmlab_segmentation import postprocess
+
+    resized = F.interpolate(postprocess.unpad(logits, meta), size=size, mode="bilinear", align_corners=align_corners)
+    if resized.shape[1] > 1:
+        return resized[0].argmax(dim=0).to(torch.uint8).numpy()
+
+    return (resized[0, 0].sigmoid() > threshold).to(torch.uint8).numpy()
+
+
+def test_mask_from_logits():
+    import torch
+    from infer_mmlab_segmentation import postprocess
+
+    generator = torch.Generator().manual_seed(0)
+    ori_shape = (93, 141)
+    meta = dict(ori_shape=ori_shape, img_padding_size=[0, 5, 0, 3], flip=True, flip_direction="horizontal")
+    # float64: no argmax ties between the two resize paths
+    for num_classes, threshold in ((5, 0.5), (1, 0.3)):
+        logits = torch.randn((1, num_classes, 27, 41), generator=generator, dtype=torch.float64)
+        for align_corners in (False, True):
+            name = f"mask_from_logits (classes={num_classes}, align_corners={align_corners})"
+            ref = _reference_mask(logits, meta, align_corners, threshold, ori_shape)
+            mask = postprocess.mask_from_logits(logits, meta, align_corners, threshold)
+            _check_masks([mask], [ref], name)
+
+            # Crop of the full resolution mask, written in a preallocated buffer
+            roi = (17, 9, 60, 71)
+            out = np.empty((71, 60), dtype=np.uint8)
+            postprocess.mask_from_logits(logits, meta, align_corners, threshold, roi=roi, out=out)
+            _check_masks([out], [ref[9:80, 17:77]], f"{name}, roi")
+
+        # Downsampling samples pixel centres, as F.interpolate with align_corners=False
+        out_shape = postprocess.output_shape(ori_shape, scale=0.37)
+        ref = _reference_mask(logits, meta, False, threshold, out_shape)
+        mask = postprocess.mask_from_logits(logits, meta, False, threshold, scale=0.37)
+        _check_masks([mask], [ref], f"mask_from_logits (classes={num_classes}), scale")
+
+
+def _quantizable_loader():
+    # Stand-in model with a conv + BatchNorm + ReLU backbone and a decode head, as in mmseg
+    import types
+
+    import torch
+
+    class Backbone(torch.nn.Module):
+
+        def __init__(self):
+            super().__init__()
+            self.conv = torch.nn.Conv2d(3, 8, 3, padding=1)
+            self.bn = torch.nn.BatchNorm2d(8)
+            self.relu = torch.nn.ReLU()
+
+        def forward(self, x):
+            return (self.relu(self.bn(self.conv(x))),)
+
+    class Head(torch.nn.Module):
+
+        def __init__(self):
+            super().__init__()
+            self.conv_seg = torch.nn.Conv2d(8, 4, 1)
+
+        def forward(self, inputs):
+            return self.conv_seg(inputs[-1])
+
+    torch.manual_seed(0)
+    model, pipeline = _stand_in_loader("cpu")
+    model.backbone, model.decode_head = Backbone(), Head()
+    with torch.no_grad():
+        model.backbone.bn.running_mean.uniform_(-0.2, 0.2)
+        model.backbone.bn.running_var.uniform_(0.5, 2.0)
+    model.inference = types.MethodType(lambda self, inputs, metas: self.decode_head(self.backbone(inputs / 255)),
+                                       model)
+    return model.eval(), pipeline
+
+
+def test_static_quantization():
+    # The calibrated model is cached with its masks on the first calibration images: reloaded, it
+    # must give the same masks, and a cache that does not is calibrated again
+    import tempfile
+
+    import torch
+    from infer_mmlab_segmentation import inference, quantization
+
+    with tempfile.TemporaryDirectory() as folder:
+        calibration_folder = os.path.join(folder, "calibration")
+        os.makedirs(calibration_folder)
+        for i, image in enumerate(_test_images(4)):
+            cv2.imwrite(os.path.join(calibration_folder, f"{i}.png"), image)
+        ckpt_file = os.path.join(folder, "model.pth")
+        cache_file = quantization.static_cache_path(ckpt_file)
+        images = [quantization.read_image(f) for f in quantization.list_images(calibration_folder)]
+
+        model, pipeline = _quantizable_loader()
+        model = quantization.quantize_static(model, pipeline, ckpt_file, calibration_folder)
+        for name in ("backbone", "decode_head"):
+            if not isinstance(getattr(getattr(model, name), quantization._GRAPH, None), torch.fx.GraphModule):
+                raise Exception(f"Static INT8: {name} not quantized as a graph")
+        expected = inference.infer_batch(model, pipeline, images)
+
+        mtime = os.path.getmtime(cache_file)
+        model, pipeline = _quantizable_loader()
+        model = quantization.quantize_static(model, pipeline, ckpt_file, calibration_folder)
+        if os.path.getmtime(cache_file) != mtime:
+            raise Exception("Static INT8: cached model not reused")
+        _check_masks(inference.infer_batch(model, pipeline, images), expected, "Static INT8 reloaded")
+
+        cached = torch.load(cache_file)
+        cached["masks"][0] = 1 - cached["masks"][0]
+        torch.save(cached, cache_file)
+        model, pipeline = _quantizable_loader()
+        model = quantization.quantize_static(model, pipeline, ckpt_file, calibration_folder)
+        masks = [m.numpy() for m in torch.load(cache_file)["masks"]]
+        _check_masks(masks, expected[:len(masks)], "Static INT8 recalibrated cache")
+        _check_masks(inference.infer_batch(model, pipeline, images), expected, "Static INT8 recalibrated")
+
+
+def test_tiled_inference():
+    # The stand-in model sees each pixel alone: tiled masks must equal whole image masks,
+    # which checks tile coverage, band flushes at the borders and normalization by the weights
+    from infer_mmlab_segmentation import inference, tiling
+
+    model, pipeline = _stand_in_loader("cpu")
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, (150, 230, 3), dtype=np.uint8)
+    expected = inference.infer_batch(model, pipeline, [image])
+    for blending in tiling.BLENDING_MODES:
+        for tile_size, overlap, batch_size in ((64, 16, 3), (100, 0, 1), (256, 32, 2)):
+            mask = tiling.infer_tiled(model, pipeline, image, tile_size, overlap, blending, batch_size)
+            _check_masks([mask], expected, f"Tiled inference ({blending}, {tile_size}/{overlap})")
+
+    try:
+        tiling.infer_tiled(model, pipeline, image, tile_size=64, overlap=64)
+    except Exception:
+        pass
+    else:
+        raise Exception("Tile overlap of a whole tile accepted")
+
+
+def test_overlapped_inference():
+    # Overlapped stages on CPU (NullStreams) give the masks of sequential inference, in order
+    from infer_mmlab_segmentation import device_streams, inference, streaming
+
+    model, pipeline = _stand_in_loader("cpu")
+    frames = _test_images(12)
+    expected = [inference.infer_batch(model, pipeline, [frame])[0] for frame in frames]
+
+    overlapped = device_streams.OverlappedInference(model, pipeline, slots=4)
+    if not isinstance(overlapped.streams, device_streams.NullStreams):
+        raise Exception("CPU models must run the overlapped stages with NullStreams")
+
+    _check_masks([overlapped.infer(frame) for frame in frames], expected, "OverlappedInference.infer")
+    _check_masks(list(streaming.run_pipeline(frames, overlapped.stages(), 2)), expected, "Overlapped stream")
+
+
+class _GatedReplica:
+    # In-process replica answering once its gate is open, to control which replica is busy
+
+    def __init__(self, gate):
+        self.gate = gate
+        self.device = "cpu"
+        self.classes = ["a"]
+        self.images = []
+
+    def start(self):
+        pass
+
+    def wait_ready(self):
+        pass
+
+    def send(self, images, **kwargs):
+        self.gate.wait()
+        self.images.extend(images)
+        return images
+
+    def receive(self, ticket):
+        return ticket
+
+    def close(self):
+        pass
+
+
+def test_device_pool():
+    import threading
+    from infer_mmlab_segmentation import device_pool, devices, inference
+
+    # Least pending dispatch: a busy replica gets no new image while another one is idle
+    busy, idle = threading.Event(), threading.Event()
+    idle.set()
+    replicas = [_GatedReplica(busy), _GatedReplica(idle)]
+    pool = device_pool.DevicePool(replicas)
+    first = pool.submit(0)
+    for image in (1, 2):
+        if pool.submit(image).result(timeout=10) != image:
+            raise Exception("Device pool returned the result of another request")
+    busy.set()
+    if first.result(timeout=10) != 0 or replicas[0].images != [0] or replicas[1].images != [1, 2]:
+        raise Exception(f"Requests not sent to the least busy replica: {replicas[0].images}, {replicas[1].images}")
+    pool.close()
+
+    # Requests still pending after the close timeout fail instead of being dropped
+    gate = threading.Event()
+    pool = device_pool.DevicePool([_GatedReplica(gate)])
+    future = pool.submit(0)
+    pool.close(timeout=0.1)
+    gate.set()
+    if future.exception(timeout=10) is None:
+        raise Exception("Pending request not failed by DevicePool.close()")
+
+    # Pinned worker processes: masks in input order, accepted requests served by close()
+    cpus = devices.available_cpus()
+    replicas = [device_pool.ProcessReplica(cpus[:1], _stand_in_loader, num_threads=1),
+                device_pool.ProcessReplica(cpus[-1:], _stand_in_loader, num_threads=1)]
+    pool = device_pool.DevicePool(replicas, max_batch=2)
+    try:
+        images = _test_images(16)
+        model, pipeline = _stand_in_loader("cpu")
+        expected = [inference.infer_batch(model, pipeline, [img])[0] for img in images]
+        _check_masks(pool.infer_batch(images), expected, "Device pool")
+        _check_masks(list(pool.map(iter(images))), expected, "Device pool map")
+        futures = [pool.submit(img) for img in images]
+    finally:
+        pool.close()
+
+    _check_masks([f.result(timeout=0) for f in futures], expected, "Device pool close")
+    if any(replica.process is not None for replica in replicas):
+        raise Exception("Worker processes still running after DevicePool.close()")
+
+
+def test_shm_transport():
+    # Parent arena -> worker attachment -> parent, through a growing block
+    from multiprocessing import shared_memory
+    from infer_mmlab_segmentation import shm_transport
+
+    arena, attachments = shm_transport.Arena(), shm_transport.Attachments()
+    names = []
+    try:
+        for images in (_test_images(3), _test_images(2, seed=1) + [np.arange(6000, dtype=np.float32)]):
+            items = arena.write(images)
+            names.append(arena.name)
+            views = shm_transport.views(attachments.get("inputs", arena.name), items)
+            if any(not np.array_equal(v, img) or v.dtype != img.dtype for v, img in zip(views, images)):
+                raise Exception("Arrays read by the worker differ from those written by the parent")
+
+            # Worker writes its results in place, the parent reads copies
+            for v in views:
+                v[...] = 0
+            del views
+            if any(r.any() for r in arena.read(items)):
+                raise Exception("Arrays written by the worker not seen by the parent")
+    finally:
+        attachments.close()
+        arena.close()
+
+    if names[0] == names[1]:
+        raise Exception("Arena not replaced by a larger block")
+    for name in names:
+        try:
+            shared_memory.SharedMemory(name=name).close()
+        except FileNotFoundError:
+            continue
+        raise Exception(f"Shared memory block {name} not removed")
+
+
+class _StandInTask:
+    # Segmentation task double for AsyncSegmenter: mask = image * 2, batches recorded
+
+    class Param:
+        batch_size = 4
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.batches = []
+
+    def get_param_object(self):
+        return self.Param
+
+    def infer_batch(self, images, scale=1.0, roi=None, timer=None, resolution=None):
+        import time
+
+        self.batches.append((len(images), scale))
+        time.sleep(self.delay)
+        return [image * 2 for image in images]
+
+
+def test_async_segmenter():
+    import asyncio
+    from infer_mmlab_segmentation import async_inference
+
+    async def micro_batching():
+        task = _StandInTask()
+        async with async_inference.AsyncSegmenter(task, max_wait_ms=50) as segmenter:
+            masks = await asyncio.gather(*[segmenter.infer(i) for i in range(10)])
+            if masks != [2 * i for i in range(10)]:
+                raise Exception(f"AsyncSegmenter returned masks of other requests: {masks}")
+            if [size for size, _ in task.batches] != [4, 4, 2]:
+                raise Exception(f"Concurrent requests not batched: {task.batches}")
+
+            # Different options are never mixed in a batch
+            task.batches.clear()
+            await asyncio.gather(segmenter.infer(1), segmenter.infer(2, scale=0.5), segmenter.infer(3))
+            if task.batches != [(1, 1.0), (1, 0.5), (1, 1.0)]:
+                raise Exception(f"Requests with different options batched together: {task.batches}")
+
+    async def timeout_and_close():
+        task = _StandInTask(delay=0.2)
+        segmenter = async_inference.AsyncSegmenter(task, max_batch=1, max_wait_ms=0)
+        try:
+            await segmenter.infer(1, timeout=0.05)
+        except asyncio.TimeoutError:
+            pass
+        else:
+            raise Exception("AsyncSegmenter request did not time out")
+
+        # A batch runs, another request waits: close() lets the first finish and cancels the other
+        running = asyncio.ensure_future(segmenter.infer(2))
+        while len(task.batches) < 2:
+            await asyncio.sleep(0.01)
+        queued = asyncio.ensure_future(segmenter.infer(3))
+        await asyncio.sleep(0)
+        await segmenter.close()
+        if await running != 4:
+            raise Exception("Running request not completed by AsyncSegmenter.close()")
+        try:
+            await queued
+        except asyncio.CancelledError:
+            pass
+        else:
+            raise Exception("Queued request not cancelled by AsyncSegmenter.close()")
+
+    asyncio.run(micro_batching())
+    asyncio.run(timeout_and_close())
+
 
 def test(t, data_dict):
     logger.info("===== Test::infer mmlab segmentation =====")
+    logger.info("----- Import time")
+    test_import_time()
+    logger.info("----- Mask extraction from logits")
+    test_mask_from_logits()
+    logger.info("----- Static INT8 cache")
+    test_static_quantization()
+    logger.info("----- Tiled inference")
+    test_tiled_inference()
+    logger.info("----- Overlapped streaming on CPU")
+    test_overlapped_inference()
+    logger.info("----- Device pool")
+    test_device_pool()
+    logger.info("----- Shared memory transport")
+    test_shm_transport()
+    logger.info("----- Asyncio API")
+    test_async_segmenter()
     logger.info("----- Use default parameters")
     img = cv2.imread(data_dict["images"]["detection"]["coco"])
     input_img_0 = t.get_input(0)
     input_img_0.set_image(img)
-    return run_for_test(t)
\ No newline at end of file
+    return run_for_test(t)
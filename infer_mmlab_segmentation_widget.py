@@ -16,18 +16,23 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import importlib.util
+
 from ikomia import core, dataprocess
 from ikomia.utils import pyqtutils, qtconversion
 from infer_mmlab_segmentation.infer_mmlab_segmentation_process import InferMmlabSegmentationParam
+from infer_mmlab_segmentation import devices, zoo_index
 
 # PyQt GUI framework
 from PyQt5.QtWidgets import *
-from torch.cuda import is_available
-import os
-import yaml
 from PyQt5 import QtCore
 
 
+def available_backends():
+    # Exported backends need optional packages, not part of the plugin requirements
+    return ["pytorch"] + [b for b in ("onnxruntime", "openvino") if importlib.util.find_spec(b) is not None]
+
+
 def completion(word_list, widget, i=True):
     """ Autocompletion of sender and subject """
     word_set = set(word_list)
@@ -74,10 +79,7 @@ class InferMmlabSegmentationWidget(core.CWorkflowTaskWidget):
 
         # Create layout : QGridLayout by default
         self.gridLayout = QGridLayout()
-        self.available_models = []
-        for dir in os.listdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), "configs")):
-            if dir != "_base_":
-                self.available_models.append(dir)
+        self.available_models = zoo_index.list_models()
 
         self.combo_model = Autocomplete(self.available_models, parent=None, i=True, allow_duplicates=False)
         self.label_model = QLabel("Model name")
@@ -95,7 +97,98 @@ class InferMmlabSegmentationWidget(core.CWorkflowTaskWidget):
 
         self.combo_config.setCurrentText(self.parameters.model_config +".py" if not self.parameters.model_config.endswith(".py") else "")
 
-        self.check_cuda = pyqtutils.append_check(self.gridLayout, "Use cuda", self.parameters.cuda and is_available())
+        self.check_cuda = pyqtutils.append_check(self.gridLayout, "Use cuda", self.parameters.cuda and devices.cuda_available())
+
+        self.edit_devices = pyqtutils.append_edit(self.gridLayout, "Devices (e.g. cuda:0,cuda:1 or numa:0,numa:1)",
+                                                  self.parameters.devices)
+
+        self.spin_process_workers = pyqtutils.append_spin(self.gridLayout, "CPU worker processes (0 = disabled)",
+                                                          self.parameters.process_workers, min=0, max=256)
+
+        self.spin_batch_size = pyqtutils.append_spin(self.gridLayout, "Batch size", self.parameters.batch_size,
+                                                     min=1, max=256)
+
+        self.spin_resolution = pyqtutils.append_double_spin(self.gridLayout, "Inference resolution",
+                                                            self.parameters.resolution, min=0.1, max=2.0, step=0.05,
+                                                            decimals=2)
+
+        self.spin_target_latency = pyqtutils.append_double_spin(self.gridLayout, "Target latency (ms, 0 = disabled)",
+                                                                self.parameters.target_latency_ms, min=0.0,
+                                                                max=60000.0, step=10.0, decimals=1)
+
+        self.spin_slide_batch_size = pyqtutils.append_spin(self.gridLayout, "Slide windows per batch",
+                                                           self.parameters.slide_batch_size, min=1, max=64)
+
+        self.check_tta = pyqtutils.append_check(self.gridLayout, "Test-time augmentation", self.parameters.tta)
+
+        self.edit_tta_scales = pyqtutils.append_edit(self.gridLayout, "TTA scales", self.parameters.tta_scales)
+
+        self.check_tta_flip = pyqtutils.append_check(self.gridLayout, "TTA horizontal flip", self.parameters.tta_flip)
+
+        self.spin_tta_agreement = pyqtutils.append_double_spin(self.gridLayout, "TTA early exit agreement (0 = disabled)",
+                                                               self.parameters.tta_agreement, min=0.0, max=1.0,
+                                                               step=0.01, decimals=3)
+
+        self.spin_tile_size = pyqtutils.append_spin(self.gridLayout, "Tile size (0 = disabled)",
+                                                    self.parameters.tile_size, min=0, max=8192, step=64)
+
+        self.spin_tile_overlap = pyqtutils.append_spin(self.gridLayout, "Tile overlap", self.parameters.tile_overlap,
+                                                       min=0, max=4096, step=16)
+
+        self.combo_tile_blending = pyqtutils.append_combo(self.gridLayout, "Tile blending")
+        self.combo_tile_blending.addItems(["uniform", "cosine", "gaussian"])
+        self.combo_tile_blending.setCurrentText(self.parameters.tile_blending)
+
+        self.check_mmap_weights = pyqtutils.append_check(self.gridLayout, "Memory-mapped weights",
+                                                         self.parameters.mmap_weights)
+
+        self.check_fixed_shape = pyqtutils.append_check(self.gridLayout, "Fixed input shape (reuse buffers)",
+                                                        self.parameters.fixed_shape)
+
+        self.check_overlap_transfers = pyqtutils.append_check(self.gridLayout, "Overlap transfers (pinned memory, CUDA streams)",
+                                                              self.parameters.overlap_transfers)
+
+        self.check_stage_timing = pyqtutils.append_check(self.gridLayout, "Per-stage timing",
+                                                         self.parameters.stage_timing)
+
+        self.combo_metrics_sink = pyqtutils.append_combo(self.gridLayout, "Metrics sink")
+        self.combo_metrics_sink.addItems(["log", "jsonl", "prometheus"])
+        self.combo_metrics_sink.setCurrentText(self.parameters.metrics_sink)
+
+        self.browse_metrics_path = pyqtutils.append_browse_file(self.gridLayout, "Metrics file",
+                                                                self.parameters.metrics_path)
+
+        self.combo_profiler = pyqtutils.append_combo(self.gridLayout, "Profiler")
+        self.combo_profiler.addItems(["none", "torch", "cprofile"])
+        self.combo_profiler.setCurrentText(self.parameters.profiler)
+
+        self.combo_precision = pyqtutils.append_combo(self.gridLayout, "Precision (INT8: CPU only)")
+        self.combo_precision.addItems(["fp32", "int8_dynamic", "int8_static"])
+        self.combo_precision.setCurrentText(self.parameters.precision)
+
+        self.browse_calibration_folder = pyqtutils.append_browse_file(self.gridLayout, "Calibration images folder",
+                                                                      self.parameters.calibration_folder,
+                                                                      mode=QFileDialog.Directory)
+
+        self.check_cpu_optimization = pyqtutils.append_check(self.gridLayout, "CPU optimization (BN folding, channels last)",
+                                                             self.parameters.cpu_optimization)
+
+        self.combo_compile_mode = pyqtutils.append_combo(self.gridLayout, "Compile mode")
+        self.combo_compile_mode.addItems(["none", "torchscript", "inductor"])
+        self.combo_compile_mode.setCurrentText(self.parameters.compile_mode)
+
+        self.combo_backend = pyqtutils.append_combo(self.gridLayout, "Backend")
+        self.combo_backend.addItems(available_backends())
+        self.combo_backend.setCurrentText(self.parameters.backend)
+
+        self.spin_intra_op_threads = pyqtutils.append_spin(self.gridLayout, "Intra-op threads (0 = auto)",
+                                                           self.parameters.intra_op_threads, min=0, max=256)
+
+        self.spin_inter_op_threads = pyqtutils.append_spin(self.gridLayout, "Inter-op threads (0 = auto)",
+                                                           self.parameters.inter_op_threads, min=0, max=256)
+
+        self.spin_num_streams = pyqtutils.append_spin(self.gridLayout, "OpenVINO streams (0 = auto)",
+                                                      self.parameters.num_streams, min=0, max=256)
 
         self.browse_custom_cfg = pyqtutils.append_browse_file(self.gridLayout, "Config file (.py)",
                                                               self.parameters.custom_cfg)
@@ -112,13 +205,8 @@ class InferMmlabSegmentationWidget(core.CWorkflowTaskWidget):
     def on_model_changed(self, s):
         self.combo_config.clear()
         model = self.combo_model.currentText()
-        yaml_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "configs", model, "metafile.yaml")
-        if os.path.isfile(yaml_file):
-            with open(yaml_file, "r") as f:
-                models_list = yaml.load(f, Loader=yaml.FullLoader)['Models']
-            available_cfg = [model_dict["Name"] for
-                             model_dict in models_list
-                             if "Weights" in model_dict]
+        available_cfg = zoo_index.list_configs(model, with_weights=True)
+        if available_cfg:
             self.combo_config.addItems(available_cfg)
             self.combo_config.setCurrentText(available_cfg[0])
 
@@ -129,6 +217,34 @@ class InferMmlabSegmentationWidget(core.CWorkflowTaskWidget):
         # Get parameters from widget
         # Example : self.parameters.windowSize = self.spinWindowSize.value()
         self.parameters.cuda = self.check_cuda.isChecked()
+        self.parameters.devices = self.edit_devices.text()
+        self.parameters.process_workers = self.spin_process_workers.value()
+        self.parameters.batch_size = self.spin_batch_size.value()
+        self.parameters.mmap_weights = self.check_mmap_weights.isChecked()
+        self.parameters.fixed_shape = self.check_fixed_shape.isChecked()
+        self.parameters.overlap_transfers = self.check_overlap_transfers.isChecked()
+        self.parameters.stage_timing = self.check_stage_timing.isChecked()
+        self.parameters.metrics_sink = self.combo_metrics_sink.currentText()
+        self.parameters.metrics_path = self.browse_metrics_path.path
+        self.parameters.profiler = self.combo_profiler.currentText()
+        self.parameters.precision = self.combo_precision.currentText()
+        self.parameters.calibration_folder = self.browse_calibration_folder.path
+        self.parameters.cpu_optimization = self.check_cpu_optimization.isChecked()
+        self.parameters.compile_mode = self.combo_compile_mode.currentText()
+        self.parameters.backend = self.combo_backend.currentText()
+        self.parameters.intra_op_threads = self.spin_intra_op_threads.value()
+        self.parameters.inter_op_threads = self.spin_inter_op_threads.value()
+        self.parameters.num_streams = self.spin_num_streams.value()
+        self.parameters.resolution = self.spin_resolution.value()
+        self.parameters.target_latency_ms = self.spin_target_latency.value()
+        self.parameters.slide_batch_size = self.spin_slide_batch_size.value()
+        self.parameters.tta = self.check_tta.isChecked()
+        self.parameters.tta_scales = self.edit_tta_scales.text()
+        self.parameters.tta_flip = self.check_tta_flip.isChecked()
+        self.parameters.tta_agreement = self.spin_tta_agreement.value()
+        self.parameters.tile_size = self.spin_tile_size.value()
+        self.parameters.tile_overlap = self.spin_tile_overlap.value()
+        self.parameters.tile_blending = self.combo_tile_blending.currentText()
         self.parameters.model_config = self.combo_config.currentText()
         self.parameters.model_name = self.combo_model.currentText()
         self.parameters.model_weight_file = self.browse_custom_weights.path
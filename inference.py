@@ -0,0 +1,122 @@
+# Copyright (C) 2021 Ikomia SAS
+# Contact: https://www.ikomia.com
+#
+# This file is part of the IkomiaStudio software.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import threading
+from collections import OrderedDict, defaultdict
+
+import torch
+from mmengine.dataset import Compose
+from mmseg.apis import init_model
+
+from infer_mmlab_segmentation import checkpoint_mmap, checkpoint_store, config_cache, dynamic_resolution, postprocess, \
+    profiling
+
+_registry_lock = threading.Lock()
+_registered = False
+
+
+def register_modules():
+    # mmseg registries are process-wide: filled once, before the first model is built
+    global _registered
+    with _registry_lock:
+        if not _registered:
+            from mmseg.utils import register_all_modules
+
+            register_all_modules()
+            _registered = True
+
+
+def init_segmentor(cfg_file, ckpt_file, device, mmap_weights=False):
+    register_modules()
+    # Weights URL -> local checkpoint store, downloaded only if missing
+    ckpt_file = checkpoint_store.resolve(ckpt_file)
+    # Config with its _base_ chain resolved once, then loaded from the config cache
+    config = config_cache.load_config(cfg_file)
+    if mmap_weights:
+        model = checkpoint_mmap.init_model_mmap(config, ckpt_file, device=device)
+    else:
+        model = init_model(config, ckpt_file, device=device)
+
+    # trick to avoid KeyError "seg_map_path" when loading annotations
+    model.cfg.test_pipeline = [t for t in model.cfg.test_pipeline if "reduce_zero_label" not in t]
+    return model
+
+
+# --------------------
+# - Building blocks of mmseg.apis.inference_model, split so that pipeline,
+# - forward pass and mask extraction can be batched or run in separate stages
+# --------------------
+def build_test_pipeline(model, resolution=1.0):
+    # Same pipeline as inference_model() but built once per model instead of once per call.
+    # resolution: factor applied to the Resize scale of the config
+    pipeline_cfg = dynamic_resolution.scale_pipeline_cfg(model.cfg.test_pipeline, resolution)
+    pipeline_cfg = [t for t in pipeline_cfg if t.get("type") != "LoadAnnotations"]
+    pipeline_cfg[0]["type"] = "LoadImageFromNDArray"
+    return Compose(pipeline_cfg)
+
+
+def prepare_batch(model, pipeline, images, timer=None):
+    # Test pipeline + SegDataPreProcessor (normalisation, padding, stacking, device transfer)
+    data = defaultdict(list)
+    with profiling.stage(timer, "pipeline"):
+        for img in images:
+            sample = pipeline(dict(img=img))
+            data["inputs"].append(sample["inputs"])
+            data["data_samples"].append(sample["data_samples"])
+
+    with profiling.stage(timer, "data_preprocessor"):
+        return model.data_preprocessor(data, False)
+
+
+def predict_batch(model, data):
+    with torch.no_grad():
+        return model(**data, mode="predict")
+
+
+def predict_logits(model, data):
+    # Forward pass up to the padded logits (N, C, H, W), without EncoderDecoder.postprocess_result()
+    # which would resize them to full resolution and wrap everything in SegDataSample objects
+    batch_img_metas = [sample.metainfo for sample in data["data_samples"]]
+    with torch.no_grad():
+        return model.inference(data["inputs"], batch_img_metas)
+
+
+def group_by_shape(images, batch_size):
+    # Yield lists of indices sharing the same input shape, at most batch_size long.
+    # Same-shape images go through Resize identically, so the batch needs no extra padding.
+    groups = OrderedDict()
+    for i, img in enumerate(images):
+        groups.setdefault(img.shape, []).append(i)
+
+    batch_size = max(1, batch_size)
+    for indices in groups.values():
+        for start in range(0, len(indices), batch_size):
+            yield indices[start:start + batch_size]
+
+
+def infer_batch(model, pipeline, images, batch_size=1, scale=1.0, roi=None, timer=None):
+    masks = [None] * len(images)
+    for indices in group_by_shape(images, batch_size):
+        data = prepare_batch(model, pipeline, [images[i] for i in indices], timer)
+        with profiling.stage(timer, "forward"):
+            logits = predict_logits(model, data)
+        with profiling.stage(timer, "postprocess"):
+            batch_masks = postprocess.masks_from_logits(model, logits, data["data_samples"], scale, roi)
+        for i, mask in zip(indices, batch_masks):
+            masks[i] = mask
+
+    return masks
@@ -0,0 +1,138 @@
+# Copyright (C) 2021 Ikomia SAS
+# Contact: https://www.ikomia.com
+#
+# This file is part of the IkomiaStudio software.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import threading
+from collections import OrderedDict
+
+# Memory kept for models no task is using anymore, overridable per process
+DEFAULT_MEMORY_BUDGET_MB = int(os.environ.get("IKOMIA_MMSEG_MODEL_CACHE_MB", 2048))
+
+
+def model_nbytes(model):
+    # Exported runtimes (backends.py) report their own size
+    if hasattr(model, "nbytes"):
+        return model.nbytes
+
+    params = sum(p.numel() * p.element_size() for p in model.parameters())
+    buffers = sum(b.numel() * b.element_size() for b in model.buffers())
+    return params + buffers
+
+
+def make_key(cfg_file, ckpt_file, device, precision="fp32", **options):
+    # Config modification time is part of the key so that edited custom configs are reloaded.
+    # options: backend settings giving a different model object (backend, threads...)
+    cfg_mtime = os.path.getmtime(cfg_file) if os.path.isfile(cfg_file) else None
+    return os.path.abspath(cfg_file), cfg_mtime, ckpt_file, device, precision, tuple(sorted(options.items()))
+
+
+class _Entry:
+
+    def __init__(self, model):
+        self.model = model
+        self.refcount = 0
+        self._nbytes = None if hasattr(model, "nbytes") else model_nbytes(model)
+
+    @property
+    def nbytes(self):
+        # Exported runtimes grow with the graphs exported after loading
+        return self.model.nbytes if self._nbytes is None else self._nbytes
+
+
+class ModelRegistry:
+    # Process-wide models shared between task instances: one copy per key,
+    # reference counted, unused models evicted in LRU order above the budget.
+
+    def __init__(self, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self._lock = threading.Lock()
+        # key -> [lock, callers holding or waiting for it]
+        self._key_locks = {}
+        self._entries = OrderedDict()
+
+    def set_memory_budget(self, memory_budget_mb):
+        with self._lock:
+            self.memory_budget = memory_budget_mb * 1024 * 1024
+            self._evict()
+
+    def acquire(self, key, loader):
+        # Per-key lock: concurrent requests for the same model load it once,
+        # while different models can load in parallel. The lock only exists while
+        # callers hold or wait for it, so that keys of evicted or failed models do not pile up.
+        with self._lock:
+            key_lock = self._key_locks.get(key)
+            if key_lock is None:
+                key_lock = self._key_locks[key] = [threading.Lock(), 0]
+            key_lock[1] += 1
+
+        try:
+            with key_lock[0]:
+                with self._lock:
+                    entry = self._entries.get(key)
+                    if entry is not None:
+                        entry.refcount += 1
+                        self._entries.move_to_end(key)
+                        return entry.model
+
+                entry = _Entry(loader())
+                with self._lock:
+                    entry.refcount += 1
+                    self._entries[key] = entry
+                    self._evict()
+                    return entry.model
+        finally:
+            with self._lock:
+                key_lock[1] -= 1
+                if key_lock[1] == 0:
+                    del self._key_locks[key]
+
+    def release(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+
+            entry.refcount = max(0, entry.refcount - 1)
+            self._evict()
+
+    def clear(self):
+        # Drop every model not currently used by a task
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if e.refcount == 0]:
+                del self._entries[key]
+
+    def memory_usage(self):
+        with self._lock:
+            return sum(e.nbytes for e in self._entries.values())
+
+    def _evict(self):
+        total = sum(e.nbytes for e in self._entries.values())
+        for key in list(self._entries.keys()):
+            if total <= self.memory_budget:
+                break
+
+            entry = self._entries[key]
+            if entry.refcount == 0:
+                total -= entry.nbytes
+                del self._entries[key]
+
+
+_registry = ModelRegistry()
+
+
+def get_registry():
+    return _registry
@@ -0,0 +1,119 @@
+# Copyright (C) 2021 Ikomia SAS
+# Contact: https://www.ikomia.com
+#
+# This file is part of the IkomiaStudio software.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+# Upper bound of the resized logits materialized at once
+CHUNK_BYTES = 64 * 1024 * 1024
+
+
+def _threshold(model):
+    decode_head = model.decode_head
+    if isinstance(decode_head, torch.nn.ModuleList):
+        decode_head = decode_head[-1]
+
+    threshold = getattr(decode_head, "threshold", None)
+    return 0.5 if threshold is None else threshold
+
+
+def _normalized(coords, size, align_corners):
+    # Original image continuous coordinates (pixel centres at k + 0.5) -> grid_sample coordinates.
+    # Sampling at full resolution gives exactly F.interpolate(size=ori_shape).
+    if align_corners:
+        return (coords - 0.5) / max(size - 1, 1) * 2 - 1
+
+    return coords / size * 2 - 1
+
+
+def padding(meta):
+    # (left, right, top, bottom) padding added by the data preprocessor
+    if "img_padding_size" in meta:
+        return meta["img_padding_size"]
+
+    return meta.get("padding_size", [0] * 4)
+
+
+def unpad(logits, meta):
+    # Same padding removal and flip as EncoderDecoder.postprocess_result()
+    left, right, top, bottom = padding(meta)
+    h, w = logits.shape[-2:]
+    logits = logits[:, :, top:h - bottom, left:w - right]
+
+    if meta.get("flip", False):
+        dim = 3 if meta.get("flip_direction", "horizontal") == "horizontal" else 2
+        logits = logits.flip(dims=[dim])
+
+    return logits
+
+
+def output_shape(ori_shape, scale=1.0, roi=None):
+    x, y, w, h = roi if roi is not None else (0, 0, ori_shape[1], ori_shape[0])
+    return max(1, round(h * scale)), max(1, round(w * scale))
+
+
+def mask_from_logits(logits, meta, align_corners=False, threshold=0.5, scale=1.0, roi=None, out=None):
+    # logits: (1, C, H, W) padded logits of one image, on the compute device.
+    # Resize to the original size, argmax and uint8 conversion are fused and done by
+    # chunks of rows, so the full resolution float logits are never allocated.
+    # scale < 1 gives a downsampled mask, roi=(x, y, w, h) a crop in original image coordinates.
+    # out: preallocated uint8 numpy array, or torch tensor on any device (e.g. the compute
+    # device, the mask being downloaded later).
+    logits = unpad(logits, meta)
+    ori_h, ori_w = meta["ori_shape"][:2]
+    x0, y0, roi_w, roi_h = roi if roi is not None else (0, 0, ori_w, ori_h)
+    out_h, out_w = output_shape((ori_h, ori_w), scale, roi)
+
+    if out is None:
+        out = np.empty((out_h, out_w), dtype=np.uint8)
+    elif tuple(out.shape) != (out_h, out_w) or out.dtype not in (np.uint8, torch.uint8):
+        raise Exception(f"Output mask must be an uint8 array of shape {(out_h, out_w)}")
+
+    device, dtype = logits.device, logits.dtype
+    num_classes = logits.shape[1]
+    xs = x0 + (torch.arange(out_w, device=device, dtype=torch.float32) + 0.5) * roi_w / out_w
+    gx = _normalized(xs, ori_w, align_corners).to(dtype)
+
+    out_tensor = out if torch.is_tensor(out) else torch.from_numpy(out)
+    chunk_rows = max(1, CHUNK_BYTES // (num_classes * out_w * logits.element_size()))
+    for start in range(0, out_h, chunk_rows):
+        stop = min(out_h, start + chunk_rows)
+        ys = y0 + (torch.arange(start, stop, device=device, dtype=torch.float32) + 0.5) * roi_h / out_h
+        gy = _normalized(ys, ori_h, align_corners).to(dtype)
+        grid = torch.stack(torch.meshgrid(gx, gy, indexing="xy"), dim=-1).unsqueeze(0)
+        chunk = F.grid_sample(logits, grid, mode="bilinear", padding_mode="border", align_corners=align_corners)
+
+        if num_classes > 1:
+            pred = chunk[0].argmax(dim=0)
+        else:
+            pred = chunk[0, 0].sigmoid() > threshold
+
+        out_tensor[start:stop].copy_(pred.to(torch.uint8))
+
+    return out
+
+
+def masks_from_logits(model, logits, data_samples, scale=1.0, roi=None, outs=None):
+    align_corners = getattr(model, "align_corners", False)
+    threshold = _threshold(model)
+    masks = []
+    for i, sample in enumerate(data_samples):
+        out = outs[i] if outs is not None else None
+        masks.append(mask_from_logits(logits[i:i + 1], sample.metainfo, align_corners, threshold, scale, roi, out))
+
+    return masks
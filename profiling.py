@@ -0,0 +1,209 @@
+# Copyright (C) 2021 Ikomia SAS
+# Contact: https://www.ikomia.com
+#
+# This file is part of the IkomiaStudio software.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+METRICS_SINKS = ["log", "jsonl", "prometheus"]
+PROFILERS = ["none", "torch", "cprofile"]
+
+# Model sub-modules timed with forward hooks
+_MODULE_STAGES = ["backbone", "neck", "decode_head"]
+
+_active = threading.local()
+
+
+class StageTimer:
+    # Wall-clock time per named stage. With sync=True, CUDA work is waited for at the end
+    # of each stage so that asynchronous kernels are accounted to the right stage.
+
+    def __init__(self, sync=False, record_functions=False):
+        self.sync = sync
+        self.record_functions = record_functions
+        self.timings = OrderedDict()
+        self._starts = {}
+
+    def _synchronize(self):
+        if self.sync:
+            torch.cuda.synchronize()
+
+    def add(self, name, elapsed):
+        self.timings[name] = self.timings.get(name, 0.0) + elapsed
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        record = torch.profiler.record_function(name) if self.record_functions else contextlib.nullcontext()
+        with record:
+            t0 = time.perf_counter()
+            try:
+                yield
+            finally:
+                self._synchronize()
+                self.add(name, time.perf_counter() - t0)
+
+    @contextlib.contextmanager
+    def activate(self):
+        # Route the model forward hooks of the calling thread to this timer
+        previous = getattr(_active, "timer", None)
+        _active.timer = self
+        try:
+            yield self
+        finally:
+            _active.timer = previous
+
+
+def _pre_hook(name):
+    def hook(_module, _inputs):
+        timer = getattr(_active, "timer", None)
+        if timer is not None:
+            timer._synchronize()
+            timer._starts[name] = time.perf_counter()
+
+    return hook
+
+
+def _post_hook(name):
+    def hook(_module, _inputs, _outputs):
+        timer = getattr(_active, "timer", None)
+        if timer is not None and name in timer._starts:
+            timer._synchronize()
+            timer.add(name, time.perf_counter() - timer._starts.pop(name))
+
+    return hook
+
+
+def install_hooks(model):
+    # Forward hooks on backbone, neck and decode head, installed once per model.
+    # Models are shared between tasks: hooks only record for the timer active in the current thread.
+    if getattr(model, "_stage_timing_hooks", False):
+        return
+
+    for name in _MODULE_STAGES:
+        module = getattr(model, name, None)
+        if isinstance(module, torch.nn.Module):
+            module.register_forward_pre_hook(_pre_hook(name))
+            module.register_forward_hook(_post_hook(name))
+
+    model._stage_timing_hooks = True
+
+
+def stage(timer, name):
+    # No-op when timing is disabled
+    return timer.stage(name) if timer is not None else contextlib.nullcontext()
+
+
+# --------------------
+# - Metrics sinks: any object with an emit(record) method can be added to a task
+# --------------------
+class LogSink:
+
+    def emit(self, record):
+        stages = ", ".join(f"{k}={v * 1000:.2f}ms" for k, v in record["stages"].items())
+        logger.info(f"{record['model']}: {stages}")
+
+
+class JsonLinesSink:
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        with self._lock, open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+class PrometheusSink:
+    # Prometheus text format file, e.g. for the node_exporter textfile collector.
+    # Stage latencies are exported as cumulative summaries (sum and count).
+
+    metric = "infer_mmlab_segmentation_stage_seconds"
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._sums = defaultdict(float)
+        self._counts = defaultdict(int)
+
+    def emit(self, record):
+        with self._lock:
+            for name, elapsed in record["stages"].items():
+                key = (record["model"], name)
+                self._sums[key] += elapsed
+                self._counts[key] += 1
+
+            lines = [f"# HELP {self.metric} Time spent per inference stage",
+                     f"# TYPE {self.metric} summary"]
+            for (model, name), total in sorted(self._sums.items()):
+                labels = f'model="{model}",stage="{name}"'
+                lines.append(f"{self.metric}_sum{{{labels}}} {total:.6f}")
+                lines.append(f"{self.metric}_count{{{labels}}} {self._counts[(model, name)]}")
+
+            tmp_file = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_file, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(tmp_file, self.path)
+
+
+def make_sink(kind, path=""):
+    if kind == "log":
+        return LogSink()
+    elif kind in ("jsonl", "prometheus"):
+        if not path:
+            raise Exception(f"A metrics file path is required for the {kind} metrics sink")
+        return JsonLinesSink(path) if kind == "jsonl" else PrometheusSink(path)
+    else:
+        raise Exception(f"Unknown metrics sink {kind}. Available sinks are {', '.join(METRICS_SINKS)}")
+
+
+@contextlib.contextmanager
+def capture(profiler, output_folder, name, cuda=False):
+    # Optional torch.profiler (chrome trace) or cProfile (.prof) capture of the enclosed code
+    if profiler == "none":
+        yield
+        return
+
+    os.makedirs(output_folder, exist_ok=True)
+    prefix = os.path.join(output_folder, f"{name}_{time.strftime('%Y%m%d_%H%M%S')}_{time.perf_counter_ns()}")
+    if profiler == "cprofile":
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            prof.dump_stats(f"{prefix}.prof")
+    elif profiler == "torch":
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if cuda:
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+        with torch.profiler.profile(activities=activities, record_shapes=True) as prof:
+            yield
+        prof.export_chrome_trace(f"{prefix}.json")
+    else:
+        raise Exception(f"Unknown profiler {profiler}. Available profilers are {', '.join(PROFILERS)}")
@@ -0,0 +1,312 @@
+# Copyright (C) 2021 Ikomia SAS
+# Contact: https://www.ikomia.com
+#
+# This file is part of the IkomiaStudio software.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import copy
+import hashlib
+import logging
+import os
+import types
+import warnings
+
+import cv2
+import numpy as np
+import torch
+from torch.ao import quantization as tq
+from torch.ao.nn import intrinsic
+from torch.ao.quantization import quantize_fx
+
+from infer_mmlab_segmentation import checkpoint_store, cpu_optimization, inference
+
+logger = logging.getLogger(__name__)
+
+PRECISIONS = ["fp32", "int8_dynamic", "int8_static"]
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff")
+
+# Only exact types: subclasses (mmcv wrappers, MultiheadAttention out_proj...) have no quantized equivalent
+_STATIC_TYPES = (torch.nn.Conv2d, torch.nn.Linear, intrinsic.ConvReLU2d)
+# Parts of an EncoderDecoder quantized as whole graphs when they can be traced
+_SUBGRAPHS = ("backbone", "neck", "decode_head")
+# Attribute of a subgraph holding its traced and quantized forward pass
+_GRAPH = "quantized_graph"
+# Calibration images whose masks are kept with the cached model, to check it on reload
+CHECK_IMAGES = 2
+
+
+def _engine():
+    engines = torch.backends.quantized.supported_engines
+    engine = "x86" if "x86" in engines else "fbgemm" if "fbgemm" in engines else "qnnpack"
+    torch.backends.quantized.engine = engine
+    return engine
+
+
+def list_images(folder, max_images=None):
+    files = sorted(f for f in os.listdir(folder) if f.lower().endswith(IMAGE_EXTENSIONS))
+    files = [os.path.join(folder, f) for f in files]
+    return files[:max_images] if max_images else files
+
+
+def read_image(path):
+    # RGB, like images given by Ikomia to run()
+    return cv2.cvtColor(cv2.imread(path, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+
+
+def quantize_dynamic(model):
+    # Dynamic INT8: weights quantized ahead of time, activations on the fly.
+    # PyTorch only supports it for Linear layers (transformer backbones and heads).
+    _engine()
+    return tq.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def _fold_batchnorm(model, pipeline):
+    # No-op when cpu_optimization already folded the model
+    if not any(isinstance(m, torch.nn.modules.batchnorm._BatchNorm) for m in model.modules()):
+        return model
+
+    folded = cpu_optimization.fold_batchnorm(copy.deepcopy(model))
+    ok, error = cpu_optimization.verify(model, folded, cpu_optimization._verify_batch(model, pipeline))
+    if not ok:
+        logger.warning(f"BatchNorm folding changes the outputs (max error {error:.2e}), quantizing without it")
+        return model
+
+    return folded
+
+
+def _fuse_conv_relu(module):
+    # mmcv ConvModule with a folded (or without) norm layer: conv + ReLU as one INT8 op
+    for child in list(module.modules()):
+        if type(getattr(child, "conv", None)) is torch.nn.Conv2d \
+                and type(getattr(child, "activate", None)) is torch.nn.ReLU \
+                and tuple(getattr(child, "order", ())) == ("conv", "norm", "act") \
+                and type(getattr(child, "norm", None)) in (type(None), torch.nn.Identity):
+            tq.fuse_modules(child, [["conv", "activate"]], inplace=True)
+
+
+def _wrap(module, qconfig):
+    # Each convolution / linear layer becomes quantize -> int8 op -> dequantize, so that the
+    # rest of the model (attention, interpolations, custom ops) keeps running in float
+    for name, child in module.named_children():
+        if type(child) in _STATIC_TYPES:
+            wrapper = tq.QuantWrapper(child)
+            wrapper.qconfig = qconfig
+            tq.prepare(wrapper, inplace=True)
+            setattr(module, name, wrapper)
+        elif not isinstance(child, torch.fx.GraphModule):
+            _wrap(child, qconfig)
+
+
+def _graph_forward(self, *args, **kwargs):
+    return getattr(self, _GRAPH)(*args, **kwargs)
+
+
+def _prepare_graph(module, qconfig_mapping, example_inputs):
+    # The module keeps its attributes and hooks, its forward pass runs the traced graph
+    prepared = quantize_fx.prepare_fx(module, qconfig_mapping, example_inputs)
+    for name in list(module._modules):
+        delattr(module, name)
+    module.add_module(_GRAPH, prepared)
+    module.forward = types.MethodType(_graph_forward, module)
+
+
+def _example_inputs(model, data):
+    # Inputs of each subgraph for one calibration batch
+    inputs = {}
+    handles = []
+
+    def _hook(name):
+        def hook(_module, args):
+            inputs[name] = args
+        return hook
+
+    for name in _SUBGRAPHS:
+        module = getattr(model, name, None)
+        if isinstance(module, torch.nn.Module) and not isinstance(module, torch.nn.ModuleList):
+            handles.append(module.register_forward_pre_hook(_hook(name)))
+    try:
+        inference.predict_logits(model, data)
+    finally:
+        for handle in handles:
+            handle.remove()
+
+    return inputs
+
+
+def _prepare_static(model, data):
+    # Backbone, neck and decode head quantized as whole graphs (FX graph mode): conv + BatchNorm
+    # + ReLU fused, activations kept in INT8 from one layer to the next. Subgraphs that cannot be
+    # traced (shape dependent control flow of transformers, cascade heads...) and layers outside
+    # of them are quantized layer by layer.
+    engine = _engine()
+    for name, example_inputs in _example_inputs(model, data).items():
+        try:
+            _prepare_graph(getattr(model, name), tq.get_default_qconfig_mapping(engine), example_inputs)
+        except Exception as e:
+            logger.warning(f"{name} cannot be traced ({type(e).__name__}: {e}), quantized layer by layer")
+
+    _fuse_conv_relu(model)
+    _wrap(model, tq.get_default_qconfig(engine))
+    return engine
+
+
+def _convert(model):
+    for module in list(model.modules()):
+        if isinstance(getattr(module, _GRAPH, None), torch.fx.GraphModule):
+            setattr(module, _GRAPH, quantize_fx.convert_fx(getattr(module, _GRAPH)))
+        elif isinstance(module, tq.QuantWrapper):
+            tq.convert(module, inplace=True)
+
+    return model
+
+
+def _masks(model, pipeline, files):
+    # Tensors: the cache file is loaded with weights_only
+    return [torch.from_numpy(inference.infer_batch(model, pipeline, [read_image(f)])[0]) for f in files]
+
+
+def static_cache_path(ckpt_file):
+    return checkpoint_store.derived_path(ckpt_file, checkpoint_store.INT8_STATIC_SUFFIX)
+
+
+def _calibration_signature(files, engine, model):
+    # Calibration images, quantization engine and model structure (e.g. folded BatchNorm layers,
+    # traced subgraphs)
+    h = hashlib.sha1(f"{engine}:{torch.__version__}".encode())
+    h.update(",".join(model.state_dict().keys()).encode())
+    for f in files:
+        h.update(f"{os.path.basename(f)}:{os.path.getsize(f)};".encode())
+
+    return h.hexdigest()
+
+
+def quantize_static(model, pipeline, ckpt_file, calibration_folder, max_images=64):
+    # Static INT8: activation ranges observed on calibration images. The converted model
+    # is cached next to the checkpoint and reused while the calibration set is unchanged.
+    if not calibration_folder or not os.path.isdir(calibration_folder):
+        raise Exception("Static INT8 quantization requires a folder of calibration images")
+
+    files = list_images(calibration_folder, max_images)
+    if not files:
+        raise Exception(f"No calibration image found in {calibration_folder}")
+
+    model = _fold_batchnorm(model, pipeline)
+    engine = _prepare_static(model, inference.prepare_batch(model, pipeline, [read_image(files[0])]))
+    signature = _calibration_signature(files, engine, model)
+    cache_file = static_cache_path(ckpt_file)
+    check_files = files[:CHECK_IMAGES]
+
+    if os.path.isfile(cache_file):
+        cached = torch.load(cache_file, map_location="cpu")
+        if cached.get("calibration") == signature:
+            with warnings.catch_warnings():
+                # Observers are not calibrated, quantization parameters come from the cached state dict
+                warnings.simplefilter("ignore")
+                converted = _convert(copy.deepcopy(model))
+            converted.load_state_dict(cached["state_dict"])
+            masks = _masks(converted, pipeline, check_files)
+            expected = cached.get("masks", [])
+            if len(masks) == len(expected) and all(torch.equal(m, e) for m, e in zip(masks, expected)):
+                return converted
+
+            logger.warning(f"Cached INT8 model {cache_file} does not give its calibration masks, calibrating again")
+
+    for f in files:
+        data = inference.prepare_batch(model, pipeline, [read_image(f)])
+        inference.predict_logits(model, data)
+
+    _convert(model)
+    try:
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        torch.save({"calibration": signature, "state_dict": model.state_dict(),
+                    "masks": _masks(model, pipeline, check_files)}, tmp_file)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        logger.warning(f"Unable to cache calibrated model in {cache_file}")
+
+    return model
+
+
+def quantize(model, precision, pipeline=None, ckpt_file=None, calibration_folder=None):
+    if precision == "fp32":
+        return model
+    elif precision == "int8_dynamic":
+        return quantize_dynamic(model)
+    elif precision == "int8_static":
+        return quantize_static(model, pipeline, ckpt_file, calibration_folder)
+    else:
+        raise Exception(f"Unknown precision {precision}. Available precisions are {', '.join(PRECISIONS)}")
+
+
+def _confusion(pred, target, num_classes, ignore_index=255):
+    valid = (target != ignore_index) & (target < num_classes)
+    index = target[valid].astype(np.int64) * num_classes + pred[valid].astype(np.int64)
+    return np.bincount(index, minlength=num_classes ** 2).reshape(num_classes, num_classes)
+
+
+def _miou(confusion):
+    tp = np.diag(confusion).astype(np.float64)
+    union = confusion.sum(0) + confusion.sum(1) - tp
+    present = union > 0
+    return float((tp[present] / union[present]).mean()) if present.any() else float("nan")
+
+
+def evaluate(reference_model, infer, validation_folder, max_images=None):
+    # Accuracy of the masks given by infer(images) against `reference_model` (FP32 PyTorch)
+    # on a validation set. infer can run any backend (quantized model, exported graph...).
+    # validation_folder holds images, or "images" and "labels" sub-folders (same file
+    # stems, label maps with class indices) to also get mIoU against ground truth.
+    pipeline = inference.build_test_pipeline(reference_model)
+    image_folder = os.path.join(validation_folder, "images")
+    label_folder = os.path.join(validation_folder, "labels")
+    if not os.path.isdir(image_folder):
+        image_folder, label_folder = validation_folder, None
+    elif not os.path.isdir(label_folder):
+        label_folder = None
+
+    num_classes = len(reference_model.dataset_meta["classes"])
+    agreement = np.zeros((num_classes, num_classes), dtype=np.int64)
+    reference_vs_gt = np.zeros_like(agreement)
+    model_vs_gt = np.zeros_like(agreement)
+    same_pixels, total_pixels = 0, 0
+    files = list_images(image_folder, max_images)
+
+    for f in files:
+        image = read_image(f)
+        reference_mask = inference.infer_batch(reference_model, pipeline, [image])[0]
+        mask = infer([image])[0]
+        agreement += _confusion(mask, reference_mask, num_classes)
+        same_pixels += int((mask == reference_mask).sum())
+        total_pixels += mask.size
+
+        if label_folder is not None:
+            stem = os.path.splitext(os.path.basename(f))[0]
+            label_file = next((os.path.join(label_folder, stem + ext) for ext in IMAGE_EXTENSIONS
+                               if os.path.isfile(os.path.join(label_folder, stem + ext))), None)
+            if label_file is not None:
+                label = cv2.imread(label_file, cv2.IMREAD_UNCHANGED)
+                reference_vs_gt += _confusion(reference_mask, label, num_classes)
+                model_vs_gt += _confusion(mask, label, num_classes)
+
+    report = {
+        "images": len(files),
+        "pixel_agreement": same_pixels / total_pixels if total_pixels else float("nan"),
+        "miou_vs_reference": _miou(agreement),
+    }
+    if reference_vs_gt.any():
+        report["reference_miou"] = _miou(reference_vs_gt)
+        report["miou"] = _miou(model_vs_gt)
+        report["delta_miou"] = report["miou"] - report["reference_miou"]
+
+    return report
@@ -0,0 +1,110 @@
+# Copyright (C) 2021 Ikomia SAS
+# Contact: https://www.ikomia.com
+#
+# This file is part of the IkomiaStudio software.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Offsets of arrays in an arena, for aligned numpy views
+ALIGNMENT = 64
+
+
+def _aligned(n):
+    return -(-n // ALIGNMENT) * ALIGNMENT
+
+
+def layout(specs):
+    # [(shape, dtype)] -> [(offset, shape, dtype str)] of arrays stored back to back, and total size in bytes
+    items = []
+    offset = 0
+    for shape, dtype in specs:
+        dtype = np.dtype(dtype)
+        items.append((offset, tuple(shape), dtype.str))
+        offset += _aligned(int(np.prod(shape)) * dtype.itemsize)
+
+    return items, offset
+
+
+def views(buf, items):
+    return [np.ndarray(shape, dtype=np.dtype(dtype), buffer=buf, offset=offset) for offset, shape, dtype in items]
+
+
+class Arena:
+    # Shared memory block owned by the parent process, reused from one request to the next and
+    # replaced by a larger one when needed. Workers attach to it by name.
+
+    def __init__(self):
+        self.shm = None
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def reserve(self, nbytes):
+        if self.shm is None or self.shm.size < nbytes:
+            size = max(nbytes, 2 * self.shm.size if self.shm is not None else 0, ALIGNMENT)
+            self.close()
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+
+        return self.shm.buf
+
+    def write(self, arrays):
+        items, nbytes = layout([(a.shape, a.dtype) for a in arrays])
+        buf = self.reserve(nbytes)
+        for view, array in zip(views(buf, items), arrays):
+            view[...] = array
+
+        return items
+
+    def read(self, items):
+        return [v.copy() for v in views(self.shm.buf, items)]
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+def _close(shm):
+    try:
+        shm.close()
+    except BufferError:
+        # Views still referenced: the mapping goes away with them
+        pass
+
+
+class Attachments:
+    # Worker side: arenas attached by name, reattached when the parent replaces one
+
+    def __init__(self):
+        self._shms = {}
+
+    def get(self, key, name):
+        shm = self._shms.get(key)
+        if shm is None or shm.name != name:
+            if shm is not None:
+                _close(shm)
+            # Spawned workers share the resource tracker of the parent, which unlinks the block
+            self._shms[key] = shm = shared_memory.SharedMemory(name=name)
+
+        return shm.buf
+
+    def close(self):
+        for shm in self._shms.values():
+            _close(shm)
+        self._shms = {}
@@ -0,0 +1,89 @@
+# Copyright (C) 2021 Ikomia SAS
+# Contact: https://www.ikomia.com
+#
+# This file is part of the IkomiaStudio software.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import torch
+
+from infer_mmlab_segmentation import postprocess
+
+
+def window_starts(size, crop, stride):
+    # Same grid as EncoderDecoder.slide_inference(): last windows are shifted back inside the image
+    grids = max(size - crop + stride - 1, 0) // stride + 1
+    starts = []
+    for i in range(grids):
+        end = min(i * stride + crop, size)
+        starts.append(max(end - crop, 0))
+
+    return starts
+
+
+def _valid_area(meta, h, w):
+    # Area of the batch tensor holding the image, padding excluded
+    left, right, top, bottom = postprocess.padding(meta)
+    return top, h - bottom, left, w - right
+
+
+class SlideInference:
+    # Replacement of EncoderDecoder.slide_inference() with the same windows and averaging:
+    # - windows of all the images of the batch go through encode_decode() by groups of
+    #   windows_per_batch instead of one at a time,
+    # - windows entirely in the padding of an image are skipped,
+    # - logits are accumulated in place in the window area, without the padded full size
+    #   copy of every window, and the window count is kept as uint8 when possible.
+
+    def __init__(self, model, windows_per_batch=4):
+        self.model = model
+        self.windows_per_batch = max(1, windows_per_batch)
+
+    def __call__(self, inputs, batch_img_metas):
+        h_stride, w_stride = self.model.test_cfg.stride
+        h_crop, w_crop = self.model.test_cfg.crop_size
+        batch_size, _, h_img, w_img = inputs.shape
+        ys = window_starts(h_img, h_crop, h_stride)
+        xs = window_starts(w_img, w_crop, w_stride)
+        h_win, w_win = min(h_crop, h_img), min(w_crop, w_img)
+
+        windows = []
+        for i, meta in enumerate(batch_img_metas):
+            top, bottom, left, right = _valid_area(meta, h_img, w_img)
+            windows.extend((i, y, x) for y in ys for x in xs
+                           if y < bottom and y + h_win > top and x < right and x + w_win > left)
+
+        preds = inputs.new_zeros((batch_size, self.model.out_channels, h_img, w_img))
+        overlap = -(-h_win // h_stride) * -(-w_win // w_stride)
+        count = torch.zeros((batch_size, 1, h_img, w_img), dtype=torch.uint8 if overlap < 256 else torch.int32,
+                            device=inputs.device)
+        # torch.Size, like mmseg: decode heads resize to pad_shape otherwise
+        crop_metas = [dict(batch_img_metas[0], img_shape=torch.Size((h_win, w_win)))]
+        for start in range(0, len(windows), self.windows_per_batch):
+            group = windows[start:start + self.windows_per_batch]
+            crops = torch.cat([inputs[i:i + 1, :, y:y + h_win, x:x + w_win] for i, y, x in group])
+            logits = self.model.encode_decode(crops, crop_metas * len(group))
+            for (i, y, x), logit in zip(group, logits):
+                preds[i, :, y:y + h_win, x:x + w_win] += logit
+                count[i, :, y:y + h_win, x:x + w_win] += 1
+
+        # Skipped padding areas are never counted, they are removed with the padding afterwards
+        return preds.div_(count.clamp_(min=1))
+
+
+def apply(model, windows_per_batch=4):
+    if getattr(model, "test_cfg", None) is None or model.test_cfg.get("mode", "whole") != "slide":
+        return model
+
+    model.slide_inference = SlideInference(model, windows_per_batch)
+    return model
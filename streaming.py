@@ -0,0 +1,127 @@
+# Copyright (C) 2021 Ikomia SAS
+# Contact: https://www.ikomia.com
+#
+# This file is part of the IkomiaStudio software.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import queue
+import threading
+
+_END = object()
+_POLL_TIMEOUT = 0.1
+
+
+class _Failure:
+
+    def __init__(self, exc):
+        self.exc = exc
+
+
+def _put(q, item, stop):
+    # Blocking put (backpressure) that still gives up when the consumer is gone
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=_POLL_TIMEOUT)
+            return True
+        except queue.Full:
+            continue
+
+    return False
+
+
+def _get(q, stop):
+    while True:
+        try:
+            return q.get(timeout=_POLL_TIMEOUT)
+        except queue.Empty:
+            if stop.is_set():
+                return _END
+
+
+def _source_worker(source, out_q, stop):
+    try:
+        for item in source:
+            if not _put(out_q, item, stop):
+                return
+    except BaseException as e:
+        _put(out_q, _Failure(e), stop)
+        return
+
+    _put(out_q, _END, stop)
+
+
+def _stage_worker(fn, in_q, out_q, stop):
+    while True:
+        item = _get(in_q, stop)
+        if item is _END or isinstance(item, _Failure):
+            _put(out_q, item, stop)
+            return
+
+        try:
+            result = fn(item)
+        except BaseException as e:
+            _put(out_q, _Failure(e), stop)
+            return
+
+        if not _put(out_q, result, stop):
+            return
+
+
+def run_pipeline(source, stages, queue_size=2):
+    # Run each stage callable in its own thread, connected by bounded queues.
+    # One thread per stage keeps items in order; queue_size bounds the number
+    # of in-flight items between two stages. Results are yielded in order and
+    # the first exception raised by the source or a stage is re-raised here.
+    stop = threading.Event()
+    queues = [queue.Queue(maxsize=max(1, queue_size)) for _ in range(len(stages) + 1)]
+    threads = [threading.Thread(target=_source_worker, args=(iter(source), queues[0], stop), daemon=True)]
+    for i, fn in enumerate(stages):
+        threads.append(threading.Thread(target=_stage_worker, args=(fn, queues[i], queues[i + 1], stop), daemon=True))
+
+    for t in threads:
+        t.start()
+
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is _END:
+                break
+            if isinstance(item, _Failure):
+                raise item.exc
+
+            yield item
+    finally:
+        stop.set()
+        # The source may be blocked on a live stream read: do not wait for it forever
+        for t in threads:
+            t.join(timeout=1.0)
+
+
+def video_frames(source):
+    # Decode a video file or stream URL with OpenCV, frames in RGB like Ikomia image inputs
+    import cv2
+
+    cap = cv2.VideoCapture(source)
+    if not cap.isOpened():
+        raise Exception(f"Unable to open video source {source}")
+
+    try:
+        while True:
+            ok, frame = cap.read()
+            if not ok:
+                break
+
+            yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    finally:
+        cap.release()
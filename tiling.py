@@ -0,0 +1,156 @@
+# Copyright (C) 2021 Ikomia SAS
+# Contact: https://www.ikomia.com
+#
+# This file is part of the IkomiaStudio software.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import numpy as np
+import torch
+
+from infer_mmlab_segmentation import inference, postprocess
+
+BLENDING_MODES = ["uniform", "cosine", "gaussian"]
+
+
+def tile_starts(length, tile, stride):
+    # Tile origins along one axis, the last tile being aligned on the border
+    if length <= tile:
+        return [0]
+
+    starts = list(range(0, length - tile, stride))
+    starts.append(length - tile)
+    return starts
+
+
+def _window_1d(n, blending):
+    if blending == "uniform":
+        return np.ones(n, dtype=np.float32)
+
+    i = np.arange(n, dtype=np.float32) + 0.5
+    if blending == "cosine":
+        # Hann window, strictly positive so that border pixels keep a weight
+        return (0.5 - 0.5 * np.cos(2 * np.pi * i / n)).astype(np.float32)
+    elif blending == "gaussian":
+        sigma = n / 4
+        return np.exp(-((i - n / 2) ** 2) / (2 * sigma ** 2)).astype(np.float32)
+    else:
+        raise Exception(f"Unknown tile blending {blending}. Available modes are {', '.join(BLENDING_MODES)}")
+
+
+def blending_window(height, width, blending="gaussian"):
+    return np.outer(_window_1d(height, blending), _window_1d(width, blending))
+
+
+def check_tiling(tile_size, overlap):
+    # An overlap of a whole tile would give a stride of 0: one tile per pixel
+    if tile_size <= 0:
+        raise Exception(f"Tile size must be positive, got {tile_size}")
+    if not 0 <= overlap < tile_size:
+        raise Exception(f"Tile overlap must be between 0 and the tile size ({tile_size}), got {overlap}")
+
+
+def _probabilities(results):
+    logits = torch.stack([r.seg_logits.data for r in results])
+    if logits.shape[1] == 1:
+        return logits.sigmoid()
+
+    return logits.softmax(dim=1)
+
+
+class _Band:
+    # Rolling band of blended class probabilities: num_classes x tile_height x image_width
+
+    def __init__(self, num_classes, height, width, threshold):
+        self.y0 = 0
+        self.height = height
+        self.threshold = threshold
+        self.scores = np.zeros((num_classes, height, width), dtype=np.float32)
+        self.weights = np.zeros((height, width), dtype=np.float32)
+
+    def add(self, y, x, scores, window):
+        dy = y - self.y0
+        h, w = window.shape
+        self.scores[:, dy:dy + h, x:x + w] += scores * window
+        self.weights[dy:dy + h, x:x + w] += window
+
+    def flush(self, out, rows):
+        # Write the first `rows` rows (no longer covered by upcoming tiles) and shift the band
+        rows = min(rows, out.shape[0] - self.y0)
+        if rows <= 0:
+            return
+
+        scores = self.scores[:, :rows]
+        if scores.shape[0] == 1:
+            weights = np.maximum(self.weights[:rows], 1e-12)
+            out[self.y0:self.y0 + rows] = (scores[0] / weights > self.threshold).astype(np.uint8)
+        else:
+            # Dividing by the weight sum does not change the argmax
+            out[self.y0:self.y0 + rows] = scores.argmax(axis=0).astype(np.uint8)
+
+        keep = self.height - rows
+        self.scores[:, :keep] = self.scores[:, rows:]
+        self.scores[:, keep:] = 0
+        self.weights[:keep] = self.weights[rows:]
+        self.weights[keep:] = 0
+        self.y0 += rows
+
+
+def _open_output(out, shape):
+    if out is None:
+        return np.zeros(shape, dtype=np.uint8)
+    elif isinstance(out, str):
+        # Memory-mapped .npy file, readable afterwards with np.load(path, mmap_mode="r")
+        return np.lib.format.open_memmap(out, mode="w+", dtype=np.uint8, shape=shape)
+    elif out.shape != shape or out.dtype != np.uint8:
+        raise Exception(f"Output mask must be an uint8 array of shape {shape}")
+
+    return out
+
+
+def infer_tiled(model, pipeline, image, tile_size=1024, overlap=128, blending="gaussian", batch_size=1, out=None):
+    # Sliding-tile inference with a memory footprint bounded by one band of tiles:
+    # peak memory is num_classes x tile_size x image_width floats, whatever the image height.
+    check_tiling(tile_size, overlap)
+    img_h, img_w = image.shape[:2]
+    tile_h, tile_w = min(tile_size, img_h), min(tile_size, img_w)
+    # Images smaller than a tile on one axis have a single tile along it
+    stride_h, stride_w = max(1, tile_h - overlap), max(1, tile_w - overlap)
+    window = blending_window(tile_h, tile_w, blending)
+    mask = _open_output(out, (img_h, img_w))
+
+    band = None
+    xs = tile_starts(img_w, tile_w, stride_w)
+    batch_size = max(1, batch_size)
+
+    for y in tile_starts(img_h, tile_h, stride_h):
+        if band is not None:
+            band.flush(mask, y - band.y0)
+
+        for start in range(0, len(xs), batch_size):
+            batch_xs = xs[start:start + batch_size]
+            tiles = [image[y:y + tile_h, x:x + tile_w] for x in batch_xs]
+            data = inference.prepare_batch(model, pipeline, tiles)
+            probs = _probabilities(inference.predict_batch(model, data)).cpu().numpy()
+
+            if band is None:
+                band = _Band(probs.shape[1], tile_h, img_w, postprocess._threshold(model))
+
+            for x, scores in zip(batch_xs, probs):
+                band.add(y, x, scores, window)
+
+    band.flush(mask, band.height)
+    if isinstance(mask, np.memmap):
+        mask.flush()
+
+    return mask
@@ -0,0 +1,122 @@
+# Copyright (C) 2021 Ikomia SAS
+# Contact: https://www.ikomia.com
+#
+# This file is part of the IkomiaStudio software.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import torch
+import torch.nn.functional as F
+
+from infer_mmlab_segmentation import inference, postprocess, profiling
+
+# img_ratios of the tta_pipeline of the dataset configs
+TTA_SCALES = [0.5, 0.75, 1.0, 1.25, 1.5, 1.75]
+
+
+def parse_scales(scales):
+    # "0.5,1.0,1.5" -> [1.0, 0.5, 1.5]: passes closest to the config scale first, they are the most
+    # accurate ones and the only ones run when early exit triggers
+    values = sorted({float(s) for s in scales.split(",") if s.strip()}, key=lambda s: (abs(s - 1.0), s))
+    if not values or min(values) <= 0:
+        raise Exception(f"Invalid TTA scales {scales}: expected positive factors like "
+                        f"{','.join(str(s) for s in TTA_SCALES)}")
+
+    return values
+
+
+def flip_inputs(inputs, meta):
+    # Horizontal flip of the image area only: padding stays on the right, as for the flipped
+    # samples of tta_pipeline (RandomFlip runs before the data preprocessor pads)
+    left, right, top, bottom = postprocess.padding(meta)
+    h, w = inputs.shape[-2:]
+    flipped = inputs.clone()
+    flipped[..., top:h - bottom, left:w - right] = inputs[..., top:h - bottom, left:w - right].flip(dims=[-1])
+    return flipped
+
+
+def _prediction(probs, threshold):
+    return probs.argmax(dim=1) if probs.shape[1] > 1 else probs[:, 0] > threshold
+
+
+class TestTimeAugmentation:
+    # Multi-scale + flip inference with the averaging of mmseg SegTTAModel (mean of softmax, or
+    # sigmoid for binary heads), without its cost:
+    # - scales are factors of the config test scale, through the same pipelines as the
+    #   resolution parameter,
+    # - the original and flipped inputs of a scale go through the model as one batch of two,
+    # - probabilities are accumulated on the compute device at the resolution of the first pass,
+    #   and only the averaged probabilities are resized to the original size,
+    # - with agreement > 0, passes stop once adding a scale changes less than 1 - agreement
+    #   of the predicted pixels.
+
+    def __init__(self, model, get_pipeline, scales=None, flip=True, agreement=0.0):
+        self.model = model
+        self.get_pipeline = get_pipeline
+        self.scales = parse_scales(scales) if isinstance(scales, str) else list(scales or TTA_SCALES)
+        self.flip = flip
+        self.agreement = agreement
+        self.align_corners = getattr(model, "align_corners", False)
+        self.threshold = postprocess._threshold(model)
+        # Number of forward passes of the last call, early exit included
+        self.passes = 0
+
+    def _add(self, probs, logit, meta):
+        logit = postprocess.unpad(logit, meta)
+        if probs is None:
+            probs = torch.zeros_like(logit, dtype=torch.float32)
+        elif logit.shape[2:] != probs.shape[2:]:
+            logit = F.interpolate(logit, size=probs.shape[2:], mode="bilinear", align_corners=self.align_corners)
+
+        return probs.add_(logit.softmax(dim=1) if logit.shape[1] > 1 else logit.sigmoid())
+
+    def probabilities(self, image, timer=None):
+        # Averaged probabilities (1, C, H, W) of the image area at the resolution of the first pass
+        probs = None
+        self.passes = 0
+        for i, ratio in enumerate(self.scales):
+            data = inference.prepare_batch(self.model, self.get_pipeline(ratio), [image], timer)
+            inputs = data["inputs"]
+            metas = [data["data_samples"][0].metainfo]
+            if self.flip:
+                inputs = torch.cat([inputs, flip_inputs(inputs, metas[0])])
+                metas.append(dict(metas[0], flip=True, flip_direction="horizontal"))
+
+            with profiling.stage(timer, "forward"), torch.no_grad():
+                logits = self.model.inference(inputs, metas)
+
+            with profiling.stage(timer, "tta_merge"):
+                previous = None
+                for j, meta in enumerate(metas):
+                    if self.agreement > 0 and self.passes > 0 and (j == 0 or i == 0):
+                        # Prediction before this scale, or before the flipped pass of the first one
+                        previous = _prediction(probs / self.passes, self.threshold)
+
+                    probs = self._add(probs, logits[j:j + 1], meta)
+                    self.passes += 1
+
+                if previous is not None and i < len(self.scales) - 1:
+                    current = _prediction(probs / self.passes, self.threshold)
+                    if (current == previous).float().mean().item() >= self.agreement:
+                        break
+
+        return probs.div_(self.passes)
+
+    def infer(self, image, scale=1.0, roi=None, timer=None):
+        probs = self.probabilities(image, timer)
+        with profiling.stage(timer, "postprocess"):
+            if probs.shape[1] == 1:
+                # mask_from_logits() thresholds sigmoid(logits)
+                probs = torch.logit(probs, eps=1e-6)
+            return postprocess.mask_from_logits(probs, {"ori_shape": image.shape[:2]}, self.align_corners,
+                                                self.threshold, scale, roi)
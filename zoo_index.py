@@ -0,0 +1,236 @@
+# Copyright (C) 2021 Ikomia SAS
+# Contact: https://www.ikomia.com
+#
+# This file is part of the IkomiaStudio software.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import hashlib
+import json
+import os
+import re
+import threading
+
+# Bump when the layout of an index entry changes
+INDEX_VERSION = 1
+
+_plugin_folder = os.path.dirname(os.path.abspath(__file__))
+_configs_folder = os.path.join(_plugin_folder, "configs")
+_index_file = os.path.join(_plugin_folder, "models", "zoo_index.json")
+
+_lock = threading.Lock()
+_index = None
+
+_base_pattern = re.compile(r"_base_\s*=\s*(\[[^\]]*\]|'[^']*'|\"[^\"]*\")", re.S)
+_string_pattern = re.compile(r"'([^']*)'|\"([^\"]*)\"")
+_mode_pattern = re.compile(r"mode\s*=\s*['\"](slide|whole)['\"]")
+_crop_pattern = re.compile(r"(\d+)x(\d+)$")
+
+
+def _metafiles():
+    # Sorted list of (model_name, metafile path) for every model folder
+    metafiles = []
+    for model_name in sorted(os.listdir(_configs_folder)):
+        if model_name.startswith('_'):
+            continue
+
+        yaml_file = os.path.join(_configs_folder, model_name, "metafile.yaml")
+        if os.path.isfile(yaml_file):
+            metafiles.append((model_name, yaml_file))
+
+    return metafiles
+
+
+def _signature(metafiles):
+    # Cheap fingerprint of the model zoo: only stat() calls, no parsing
+    h = hashlib.sha1(str(INDEX_VERSION).encode())
+    for model_name, yaml_file in metafiles:
+        st = os.stat(yaml_file)
+        h.update(f"{model_name}:{st.st_mtime_ns}:{st.st_size};".encode())
+
+    return h.hexdigest()
+
+
+def _base_files(cfg_file):
+    # Parent configs referenced by _base_, resolved relative to cfg_file
+    try:
+        with open(cfg_file, "r") as f:
+            content = f.read()
+    except OSError:
+        return "", []
+
+    match = _base_pattern.search(content)
+    if match is None:
+        return content, []
+
+    cfg_dir = os.path.dirname(cfg_file)
+    bases = [a or b for a, b in _string_pattern.findall(match.group(1))]
+    return content, [os.path.normpath(os.path.join(cfg_dir, b)) for b in bases]
+
+
+def _test_mode(cfg_file, depth=0):
+    # Lightweight textual resolution of test_cfg mode along the _base_ chain.
+    # The child config wins over its parents, like in mmengine.
+    if depth > 8:
+        return None
+
+    content, bases = _base_files(cfg_file)
+    modes = _mode_pattern.findall(content[content.find("test_cfg"):]) if "test_cfg" in content else []
+    if modes:
+        return modes[0]
+
+    for base in reversed(bases):
+        mode = _test_mode(base, depth + 1)
+        if mode is not None:
+            return mode
+
+    return None
+
+
+def config_chain(cfg_file, depth=0):
+    # cfg_file followed by every config it inherits from, each file once
+    files = [os.path.normpath(cfg_file)]
+    if depth > 8:
+        return files
+
+    for base in _base_files(cfg_file)[1]:
+        files.extend(f for f in config_chain(base, depth + 1) if f not in files)
+
+    return files
+
+
+def _build_entry(model_name, model_dict):
+    cfg = model_dict.get("Config")
+    metadata = model_dict.get("Metadata") or {}
+    results = model_dict.get("Results") or {}
+    if isinstance(results, list):
+        results = results[0] if results else {}
+
+    model_config = os.path.basename(model_dict["Name"])
+    crop = _crop_pattern.search(model_config)
+    test_mode = None
+    if cfg:
+        test_mode = _test_mode(os.path.join(_plugin_folder, cfg)) or "whole"
+
+    return {
+        "model_name": model_name,
+        "model_config": model_config,
+        "cfg": cfg,
+        "weights": model_dict.get("Weights"),
+        "dataset": results.get("Dataset"),
+        "crop_size": [int(crop.group(1)), int(crop.group(2))] if crop else None,
+        "test_mode": test_mode,
+        "memory_gb": metadata.get("Memory (GB)"),
+    }
+
+
+def build_index(metafiles=None):
+    import yaml
+
+    if metafiles is None:
+        metafiles = _metafiles()
+
+    models = {}
+    for model_name, yaml_file in metafiles:
+        with open(yaml_file, "r") as f:
+            models_list = yaml.load(f, Loader=yaml.CSafeLoader if hasattr(yaml, "CSafeLoader") else yaml.SafeLoader)
+
+        if isinstance(models_list, dict):
+            models_list = models_list.get('Models')
+
+        if not isinstance(models_list, list):
+            continue
+
+        models[model_name] = {}
+        for model_dict in models_list:
+            entry = _build_entry(model_name, model_dict)
+            models[model_name][entry["model_config"]] = entry
+
+    return {
+        "version": INDEX_VERSION,
+        "signature": _signature(metafiles),
+        "models": models,
+    }
+
+
+def _read_index(signature):
+    try:
+        with open(_index_file, "r") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if index.get("version") != INDEX_VERSION or index.get("signature") != signature:
+        return None
+
+    return index
+
+
+def _write_index(index):
+    # Atomic replace so concurrent processes never read a partial file
+    tmp_file = f"{_index_file}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(_index_file), exist_ok=True)
+        with open(tmp_file, "w") as f:
+            json.dump(index, f, separators=(",", ":"))
+        os.replace(tmp_file, _index_file)
+    except OSError:
+        # Read-only install: keep the in-memory index only
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def get_index(refresh=False):
+    global _index
+
+    with _lock:
+        if _index is not None and not refresh:
+            return _index
+
+        metafiles = _metafiles()
+        signature = _signature(metafiles)
+        index = None if refresh else _read_index(signature)
+        if index is None:
+            index = build_index(metafiles)
+            _write_index(index)
+
+        _index = index
+        return _index
+
+
+def get_entry(model_name, model_config):
+    models = get_index()["models"]
+    if model_name not in models:
+        raise Exception(f"Model name {model_name} does not exist.")
+
+    configs = models[model_name]
+    if model_config not in configs:
+        raise Exception(
+            f"{model_config} does not exist for {model_name}. Available configs for are {', '.join(list(configs.keys()))}")
+
+    return configs[model_config]
+
+
+def get_paths(model_name, model_config):
+    # Absolute config file path and weights URL of a model zoo entry
+    entry = get_entry(model_name, model_config)
+    return os.path.join(_plugin_folder, entry["cfg"]), entry["weights"]
+
+
+def list_configs(model_name, with_weights=False):
+    configs = get_index()["models"].get(model_name, {})
+    return [name for name, entry in configs.items() if entry["weights"] or not with_weights]
+
+
+def list_models():
+    return list(get_index()["models"].keys())